@@ -0,0 +1,106 @@
+"""Score posts that were stored without toxicity scores (main.py with SCORE_ON_INGEST = False)
+
+Pulls unscored posts in large chunks, scores each chunk shortest-first in model sized
+batches and writes the scores back in one transaction per chunk. Only posts whose
+scores are still NULL are read, so an interrupted run simply picks up where it
+stopped. Several processes can share a database when each gets a disjoint id range.
+
+example:
+    python backfill.py all_posts.db --processes=4
+    python backfill.py all_posts.db --start_id=1 --stop_id=2000000
+    python backfill.py all_posts.db --rescore_long
+    python backfill.py all_posts.db --scorer=quantized --checkpoint=multilingual.ckpt
+"""
+import logging
+import os
+import sqlite3
+
+from concurrent.futures import ProcessPoolExecutor
+
+import fire
+
+import sql
+import topology
+import toxicity_measure
+
+logging.basicConfig(
+     level=logging.INFO,
+     format= '[%(asctime)s] %(levelname)s - %(message)s',
+     datefmt='%H:%M:%S'
+ )
+logger = logging.getLogger(__name__)
+
+
+def split_id_range(start_id, stop_id, parts):
+    """Split [start_id, stop_id] into at most parts disjoint, contiguous ranges"""
+    size = max(1, -(-(stop_id - start_id + 1) // parts))
+    return [
+        (first, min(first + size - 1, stop_id))
+        for first in range(start_id, stop_id + 1, size)
+    ]
+
+
+def backfill_range(db_name, start_id, stop_id, chunk_size=20000, batch_size=64, rescore_long=False, scorer="detoxify", checkpoint=None, worker_settings=None):
+    """Score every unscored post with start_id <= id <= stop_id
+
+    Returns:
+        number of posts scored
+    """
+    topology.apply(worker_settings)
+    toxicity_measure.set_backend(scorer, **({"checkpoint": checkpoint} if checkpoint else {}))
+    scored = 0
+    with sqlite3.connect(db_name, detect_types=sqlite3.PARSE_DECLTYPES) as con:
+        while True:
+            rows = sql.get_unscored_posts(con, start_id, stop_id, chunk_size, rescore_long)
+            if not rows:
+                break
+            scores = toxicity_measure.measure_posts([content for _, content in rows], batch_size)
+            scored += sql.update_post_scores(con, zip((post_id for post_id, _ in rows), scores))
+            logger.info(f"Backfill [{os.getpid()}] ids {start_id}-{stop_id}: {scored} posts scored")
+    return scored
+
+
+def run(db_name, start_id=None, stop_id=None, processes=1, chunk_size=20000, batch_size=64, rescore_long=False, scorer="detoxify", checkpoint=None, pin=False):
+    """Backfill toxicity scores, optionally split over several processes
+
+    Args:
+        db_name (str): sqlite database written by main.py
+        start_id (int): first POST id to score, defaults to the lowest id
+        stop_id (int): last POST id to score, defaults to the highest id
+        processes (int): worker processes, each scores its own id range
+        chunk_size (int): unscored posts read and written per transaction
+        batch_size (int): windows per model forward pass
+        rescore_long (bool): also score long posts that older runs stored with -1 sentinels
+        scorer (str): scorer backend, see scorers.BACKENDS
+        checkpoint (str): local model checkpoint for the detoxify and quantized backends
+        pin (bool): pin every process to its own cores (Linux only)
+
+    Returns:
+        number of posts scored
+    """
+    with sqlite3.connect(db_name, detect_types=sqlite3.PARSE_DECLTYPES) as con:
+        sql.allow_pending_scores(con)
+        min_id, max_id = sql.get_post_id_range(con)
+    if min_id is None:
+        return 0
+    start_id = min_id if start_id is None else start_id
+    stop_id = max_id if stop_id is None else stop_id
+
+    if processes <= 1:
+        return backfill_range(db_name, start_id, stop_id, chunk_size, batch_size, rescore_long, scorer, checkpoint)
+
+    # every process gets its own share of the cores instead of torch's default of all of them
+    plan = topology.plan(scoring_workers=processes, reserve=0, pin=pin)
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [
+            executor.submit(
+                backfill_range, db_name, first, last, chunk_size, batch_size, rescore_long, scorer, checkpoint,
+                topology.worker_settings(plan, i),
+            )
+            for i, (first, last) in enumerate(split_id_range(start_id, stop_id, processes))
+        ]
+        return sum(fut.result() for fut in futures)
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,318 @@
+"""Offline end-to-end benchmark against a local EJMR stand-in server
+
+Serves a synthetic corpus of index and topic pages from 127.0.0.1 with configurable
+latency and error rates, swaps Detoxify for a deterministic stand-in and times the
+scrape_index, collect_topic_posts, measure_posts and sql.py write stages.
+
+example:
+    python benchmark.py --index_pages=20 --latency=0.02 --error_rate=0.01 --out=bench.json
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import fire
+import numpy as np
+
+import emjr
+import http_cache
+import main
+import sql
+import toxicity_measure
+from url_index import KnownUrls
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "econ", "job", "market", "fly", "out", "tenure", "referee", "paper", "seminar", "dean",
+    "harvard", "mit", "chicago", "lol", "macro", "micro", "metrics", "placement", "rumor", "offer",
+)
+
+
+def make_corpus(index_pages=10, topics_per_index=10, pages_per_topic=2, posts_per_page=15, seed=0):
+    """Build {path: html} for a synthetic forum shaped like the pages emjr.py parses"""
+    rng = random.Random(seed)
+    corpus = {}
+    for index in range(1, index_pages + 1):
+        rows = []
+        for t in range(topics_per_index):
+            slug = f"topic-{index}-{t}"
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+            page_links = "".join(
+                f'<a class="page-numbers" href="topic/{slug}/page/{p}">{p}</a>'
+                for p in range(2, pages_per_topic + 1)
+            )
+            rows.append(
+                f'<tr><td><a href="{{base}}topic/{slug}">{title}</a> {page_links}</td>'
+                f'<td class="num l"><a>{rng.randint(1, 59)} minutes</a></td></tr>'
+            )
+            for p in range(1, pages_per_topic + 1):
+                posts = []
+                for _ in range(posts_per_page):
+                    text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 120)))
+                    posts.append(
+                        f'<li><div class="threadauthor"><small>{rng.randint(0, 9999):04x}</small></div>'
+                        f'<div class="threadpost"><div class="post">{text}</div>'
+                        f'<div class="poststuff">{rng.randint(1, 23)} hours ago # </div></div></li>'
+                    )
+                path = f"/topic/{slug}" if p == 1 else f"/topic/{slug}/page/{p}"
+                corpus[path] = (
+                    f'<html><body><h2 class="topictitle">{title}</h2>{page_links}'
+                    f'<ul id="thread">{"".join(posts)}</ul></body></html>'
+                )
+        path = "/" if index == 1 else f"/page/{index}"
+        corpus[path] = f'<html><body><table id="latest">{"".join(rows)}</table></body></html>'
+    return corpus
+
+
+def serve(corpus, latency=0.0, error_rate=0.0, seed=0):
+    """Start a threaded HTTP server for the corpus, returns (server, base_url)"""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                server.requests += 1
+                fail = rng.random() < error_rate
+            if latency:
+                time.sleep(latency)
+            body = corpus.get(self.path.rstrip("/") or "/")
+            if fail or body is None:
+                self.send_error(503 if fail else 404)
+                return
+            data = body.replace("{base}", server.base_url).encode()
+            # validators like a real server would send, the corpus never changes so they always match
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                with lock:
+                    server.not_modified += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", server.last_modified)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.not_modified = 0
+    server.last_modified = formatdate(usegmt=True)
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.base_url
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def _summary(latencies, wall, items=None, rss=(None, None)):
+    """Stage statistics, rss is the (before, after) process peak RSS taken around the stage"""
+    latencies = sorted(latencies)
+    items = len(latencies) if items is None else items
+    rss_before, rss_after = rss
+    return {
+        "calls": len(latencies),
+        "items": items,
+        "wall_s": round(wall, 4),
+        "items_per_s": round(items / wall, 2) if wall else None,
+        "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3) if latencies else None,
+        "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3) if latencies else None,
+        # the process peak once the stage finished, and how much the stage raised it
+        "peak_rss_mb": rss_after,
+        "peak_rss_growth_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+    }
+
+
+def bench_scrape(base_url, index_pages, workers):
+    """scrape_index over every index page, collect_topic_posts timed inside it"""
+    q = queue.Queue()
+    known_urls = KnownUrls()
+    completed, total, scraped_pages = (SimpleNamespace(value=0) for _ in range(3))
+    freshness = SimpleNamespace(value=0)
+    collect_latencies = []
+    collect_topic_posts = emjr.collect_topic_posts
+
+    def timed_collect(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return collect_topic_posts(*args, **kwargs)
+        finally:
+            collect_latencies.append(time.perf_counter() - start)
+
+    def timed_scrape(url):
+        start = time.perf_counter()
+        main.scrape_index(url, q, completed, total, known_urls, freshness, scraped_pages)
+        return time.perf_counter() - start
+
+    urls = [base_url if i == 1 else f"{base_url}page/{i}" for i in range(1, index_pages + 1)]
+    # scrape_index asks collect_topic_posts for the live site, point it at the stand-in server
+    emjr.collect_topic_posts = lambda _base_url, url: timed_collect(base_url, url)
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            scrape_latencies = list(executor.map(timed_scrape, urls))
+        wall = time.perf_counter() - start
+    finally:
+        emjr.collect_topic_posts = collect_topic_posts
+
+    topics = []
+    while not q.empty():
+        topics.append(q.get())
+    return topics, scrape_latencies, collect_latencies, wall
+
+
+def bench_score(topics):
+    """Scoring as db_consumer does it, one measure_posts call and latency sample per topic"""
+    latencies = []
+    scores = []
+    start = time.perf_counter()
+    for post_dict_list in topics:
+        t = time.perf_counter()
+        scores.extend(toxicity_measure.measure_posts([post_dict["post"].strip() for post_dict in post_dict_list]))
+        latencies.append(time.perf_counter() - t)
+    return scores, latencies, time.perf_counter() - start
+
+
+def bench_write(db_name, topics, scores):
+    """The db_consumer write path, one latency sample per post"""
+    latencies = []
+    scores = iter(scores)
+    with sqlite3.connect(db_name, detect_types=sqlite3.PARSE_DECLTYPES) as con:
+        start = time.perf_counter()
+        for topic_index, post_dict_list in enumerate(topics):
+            topic_author_id = sql.create_author(con, post_dict_list[0]["author"].strip())
+            topic_title = f"benchmark topic {topic_index}"
+            for post_dict in post_dict_list:
+                t = time.perf_counter()
+                toxicity_dict = next(scores)
+                author_id = sql.create_author(con, post_dict["author"].strip())
+                topic_id = sql.create_topic(con, topic_title, topic_author_id)
+                topic_url_id = sql.create_topic_url(con, post_dict["url"].strip(), topic_author_id, topic_id)
+                sql.create_post(
+                    con, post_dict["post"].strip(), author_id, topic_id, topic_url_id, post_dict["created_at"],
+                    **{label: toxicity_dict[label] for label in sql.SCORE_COLUMNS}
+                )
+                latencies.append(time.perf_counter() - t)
+        wall = time.perf_counter() - start
+    return latencies, wall
+
+
+def run(index_pages=10, topics_per_index=10, pages_per_topic=2, posts_per_page=15, latency=0.0,
+        error_rate=0.0, score_delay=0.0, workers=8, seed=0, scorer="stand-in", http_cache_path=None, passes=1,
+        out="bench_output.json"):
+    """Run every stage once and write the results as JSON
+
+    Args:
+        index_pages (int): number of synthetic index pages
+        topics_per_index (int): topics listed on every index page
+        pages_per_topic (int): pages in every topic
+        posts_per_page (int): posts on every topic page
+        latency (float): seconds the server sleeps before every response
+        error_rate (float): fraction of requests answered with a 503
+        score_delay (float): seconds the Detoxify stand-in sleeps per forward pass
+        workers (int): scrape_index threads
+        seed (int): corpus and error seed, fixed so runs are comparable
+        scorer (str): scorer backend, the deterministic stand-in unless a real model is wanted
+        http_cache_path (str): conditional-request cache file, None runs without the cache
+        passes (int): times the scrape stage runs, later passes show what the cache saves
+        out (str): path of the JSON results file
+
+    Returns:
+        dict of results, also written to out
+    """
+    corpus = make_corpus(index_pages, topics_per_index, pages_per_topic, posts_per_page, seed)
+    server, base_url = serve(corpus, latency, error_rate, seed)
+    toxicity_measure.set_backend(scorer, **({"delay": score_delay} if scorer == "stand-in" else {}))
+    emjr.logger.setLevel(logging.CRITICAL)
+    main.logger.setLevel(logging.CRITICAL)
+
+    http_cache.configure(http_cache_path)
+    repeat_scrapes = []
+    start_rss = _peak_rss_mb()
+    try:
+        topics, scrape_latencies, collect_latencies, scrape_wall = bench_scrape(base_url, index_pages, workers)
+        scrape_rss = (start_rss, _peak_rss_mb())
+        pages_served = server.requests
+        for _ in range(passes - 1):
+            requests_before, not_modified_before = server.requests, server.not_modified
+            _, _, _, wall = bench_scrape(base_url, index_pages, workers)
+            repeat_scrapes.append({
+                "wall_s": round(wall, 4),
+                "requests": server.requests - requests_before,
+                "not_modified": server.not_modified - not_modified_before,
+            })
+    finally:
+        server.shutdown()
+        http_cache.configure(None)
+
+    posts = [post_dict for post_dict_list in topics for post_dict in post_dict_list]
+    rss_before = _peak_rss_mb()
+    scores, score_latencies, score_wall = bench_score([t for t in topics if t])
+    score_rss = (rss_before, _peak_rss_mb())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_latencies, write_wall = bench_write(os.path.join(tmp, "bench.db"), [t for t in topics if t], scores)
+    write_rss = (score_rss[1], _peak_rss_mb())
+
+    results = {
+        "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "index_pages": index_pages, "topics_per_index": topics_per_index,
+            "pages_per_topic": pages_per_topic, "posts_per_page": posts_per_page, "latency": latency,
+            "error_rate": error_rate, "score_delay": score_delay, "workers": workers, "seed": seed, "scorer": scorer,
+            "http_cache_path": http_cache_path, "passes": passes,
+        },
+        "pages_served": pages_served,
+        "pages_per_s": round(pages_served / scrape_wall, 2) if scrape_wall else None,
+        "posts": len(posts),
+        "posts_per_s": round(len(posts) / (scrape_wall + score_wall + write_wall), 2) if posts else None,
+        "stages": {
+            "scrape_index": _summary(scrape_latencies, scrape_wall, pages_served, scrape_rss),
+            "collect_topic_posts": _summary(collect_latencies, scrape_wall, len(posts), scrape_rss),
+            "measure_posts": _summary(score_latencies, score_wall, len(posts), score_rss),
+            "sql_write": _summary(write_latencies, write_wall, rss=write_rss),
+        },
+        "repeat_scrapes": repeat_scrapes,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -1,7 +1,9 @@
 import datetime
 import logging
+import time
 
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -12,6 +14,9 @@ from natsort import natsorted
 from fake_useragent import UserAgent
 from torpy.http.requests import TorRequests
 
+import http_cache
+import metrics
+
 ua = UserAgent()
 session = requests.Session()
 session.max_redirects = 60
@@ -47,31 +52,63 @@ def _get_headers():
 @retry(tries=3, delay=.5, backoff=1.2, jitter=(.1, 3), max_delay=10, logger=None)
 def _get(url):
     global session
+    # a cached page is used as is when still fresh, otherwise revalidated with its validators
+    cached, conditional, fresh = http_cache.lookup(url)
+    if fresh:
+        metrics.inc("http_cache_total", result="fresh")
+        return cached
+
+    def _requests_get():
+        response = session.get(url, allow_redirects=True, headers=dict(_get_headers(), **conditional), timeout=(60, 60))
+        if response.status_code == 304 and cached:
+            return http_cache.revalidated(cached)
+        if response.status_code == 200:
+            return http_cache.store(url, response.text, response.headers)
+        return response
+
     try:
         @retry(tries=7, delay=0.1, backoff=1.2, max_delay=4, logger=None)
         def _reg_url(url):
-            return urlopen(url, timeout=40)
+            metrics.inc("get_attempts_total", transport="urlopen")
+            with metrics.timer("http_fetch", transport="urlopen"):
+                try:
+                    return urlopen(Request(url, headers=conditional), timeout=40)
+                except HTTPError as e:
+                    if e.code == 304 and cached:
+                        return e
+                    raise
 
         try:
             response = _reg_url(url)
-            return type('obj', (object,), {'text': response.read().decode()})
+            if response.getcode() == 304:
+                return http_cache.revalidated(cached)
+            return http_cache.store(url, response.read().decode(), response.headers)
         except Exception:
-            pass
+            metrics.inc("get_fallback_total", to="requests")
 
         try:
-            return session.get(url, allow_redirects=True, headers=_get_headers(), timeout=(60, 60))
+            metrics.inc("get_attempts_total", transport="requests")
+            with metrics.timer("http_fetch", transport="requests"):
+                return _requests_get()
         except Exception:
+            metrics.inc("get_fallback_total", to="requests_fresh_cookies")
             session.cookies.clear()
 
         try:
-            return session.get(url, allow_redirects=True, headers=_get_headers(), timeout=(60, 60))
+            metrics.inc("get_attempts_total", transport="requests")
+            with metrics.timer("http_fetch", transport="requests"):
+                return _requests_get()
         except Exception:
             logger.debug('Falling back to tor')
-            with TorRequests() as tor_requests:
-                with tor_requests.get_session(retries=4) as sess:
-                   return sess.get(url)
+            metrics.inc("get_fallback_total", to="tor")
+            metrics.inc("get_attempts_total", transport="tor")
+            with metrics.timer("http_fetch", transport="tor"):
+                with TorRequests() as tor_requests:
+                    with tor_requests.get_session(retries=4) as sess:
+                       return sess.get(url)
     except Exception:
         #logger.debug('Get request failed', exc_info=True)
+        metrics.inc("get_failures_total")
         raise
 
 @retry(tries=10, delay=5, backoff=1.5, jitter=(.1, 3), max_delay=30, logger=None)
@@ -87,22 +124,27 @@ def collect_posts(url):
     #print("url ->", url)
     fhand = _get(url)
     html_content = fhand.text
-
-    soup = BeautifulSoup(html_content, 'html.parser')
-    a = {"class": "post"}
-    elements = soup("div", attrs=a)
-    authorattributes = {"class": "threadauthor"}
-    to_return = []
-    #make for loop
-    for element in elements:
-        threadpost = element.parent
-        poststuff = threadpost.find("div", {"class": "poststuff"})
-        created_at = get_dates(poststuff.text)
-        parent = element.parent.parent
-        author = parent.find("div", authorattributes).find("small").text
-        post = element.text
-        post_dictionary = {"author": author, "post": post, "created_at": created_at}
-        to_return.append(post_dictionary)
+    cached = http_cache.get_parsed("collect_posts", fhand)
+    if cached is not None:
+        return cached
+
+    with metrics.timer("html_parse", page="topic_posts"):
+        soup = BeautifulSoup(html_content, 'html.parser')
+        a = {"class": "post"}
+        elements = soup("div", attrs=a)
+        authorattributes = {"class": "threadauthor"}
+        to_return = []
+        #make for loop
+        for element in elements:
+            threadpost = element.parent
+            poststuff = threadpost.find("div", {"class": "poststuff"})
+            created_at = get_dates(poststuff.text)
+            parent = element.parent.parent
+            author = parent.find("div", authorattributes).find("small").text
+            post = element.text
+            post_dictionary = {"author": author, "post": post, "created_at": created_at}
+            to_return.append(post_dictionary)
+    http_cache.put_parsed("collect_posts", fhand, to_return)
     return to_return
 #print(collect_posts(html_content))
 
@@ -176,6 +218,11 @@ def get_discussion_urls(url):
     #print("url ->", url)
     response = _get(url)
     html_content = response.text
+    link_list = http_cache.get_parsed("get_discussion_urls", response)
+    if link_list is not None:
+        http_cache.note_last_updates(link_list)
+        return link_list
+    parse_start = time.perf_counter()
     soup = BeautifulSoup(html_content, 'html.parser')
     table = soup("table", {"id": "latest"})
   #  print(table)
@@ -205,6 +252,10 @@ def get_discussion_urls(url):
                             link = link_element.get("href")
                             topic_info["link"] = link
                             link_list.append(topic_info)
+    metrics.observe("html_parse", time.perf_counter() - parse_start, page="index")
+    http_cache.put_parsed("get_discussion_urls", response, link_list)
+    # lets the cache skip topic pages that have not changed since we last fetched them
+    http_cache.note_last_updates(link_list)
     return link_list
 
 @retry(tries=10, delay=5, backoff=1.5, jitter=(.1, 3), max_delay=30, logger=None)
@@ -216,10 +267,11 @@ def topic_urls(base_url, url):
     response = _get(url)
     #time.sleep(1)
     html_content = response.text
-    soup = BeautifulSoup(html_content, 'html.parser')
+    with metrics.timer("html_parse", page="topic_pages"):
+        soup = BeautifulSoup(html_content, 'html.parser')
 
-    a = {"class": "page-numbers"}
-    elements = soup("a", attrs=a)
+        a = {"class": "page-numbers"}
+        elements = soup("a", attrs=a)
 
     for page_element in elements:
         if page_element.text.strip().isdigit():
@@ -315,8 +367,9 @@ def collect_topic_title(url):
     response = _get(url)
     html_content = response.text
 
-    soup = BeautifulSoup(html_content, 'html.parser')
-    a = {"class": "topictitle"}
-    elements = soup("h2", attrs=a)
-    title = elements[0].text
+    with metrics.timer("html_parse", page="topic_title"):
+        soup = BeautifulSoup(html_content, 'html.parser')
+        a = {"class": "topictitle"}
+        elements = soup("h2", attrs=a)
+        title = elements[0].text
     return title
@@ -0,0 +1,183 @@
+"""Conditional-request cache under emjr._get
+
+Keeps, per URL, the zlib compressed body with its ETag / Last-Modified validators in a
+SQLite file, so a refresh can ask the server "changed since?" and get a bodyless 304
+back. Parse results are cached next to the body, keyed by the body digest, so an
+unchanged page is not parsed again either.
+
+Topic pages need no request at all when the index page says the topic's last
+activity (get_discussion_urls' last_update) came before we fetched them. Any other
+page is served without revalidation for DEFAULT_TTL seconds.
+
+Disabled unless configure() is given a path (or EJMR_HTTP_CACHE is set, which is how
+worker processes pick it up).
+"""
+import hashlib
+import logging
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get("EJMR_HTTP_CACHE")
+DEFAULT_TTL = 0 # seconds a page without last_update information is served without revalidation
+PAGE_TABLE_NAME = "PAGE"
+PARSED_TABLE_NAME = "PARSED"
+
+_connections = {}
+_last_updates = {}
+
+
+class CachedPage:
+    """What _get returns for a cached or freshly stored page, the `text` is all callers use"""
+
+    def __init__(self, url, text, digest, from_cache=False):
+        self.url = url
+        self.text = text
+        self.digest = digest
+        self.from_cache = from_cache
+
+
+def configure(path):
+    """Turn the cache on for this process and the worker processes it starts, None turns it off"""
+    global CACHE_PATH
+    CACHE_PATH = path
+    if path:
+        os.environ["EJMR_HTTP_CACHE"] = path
+    else:
+        os.environ.pop("EJMR_HTTP_CACHE", None)
+
+
+def _connection():
+    # one connection per process and thread, forked workers must not share the parent's
+    key = (os.getpid(), threading.get_ident(), CACHE_PATH)
+    con = _connections.get(key)
+    if con is None:
+        con = sqlite3.connect(CACHE_PATH, timeout=60)
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute("PRAGMA synchronous = OFF")
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {PAGE_TABLE_NAME} ("
+            "url TEXT PRIMARY KEY NOT NULL,"
+            "etag TEXT,"
+            "last_modified TEXT,"
+            "digest TEXT NOT NULL,"
+            "body BLOB NOT NULL,"
+            "fetched_at REAL NOT NULL)"
+        )
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {PARSED_TABLE_NAME} ("
+            "parser TEXT NOT NULL,"
+            "url TEXT NOT NULL,"
+            "digest TEXT NOT NULL,"
+            "data BLOB NOT NULL,"
+            "PRIMARY KEY (parser, url))"
+        )
+        con.commit()
+        _connections[key] = con
+    return con
+
+
+def topic_link(url):
+    """The topic a page url belongs to, page 2+ of a topic shares the first page's last_update"""
+    return re.sub(r"/page/\d+/?$", "", url.rstrip("/"))
+
+
+def note_last_updates(link_list):
+    """Remember when an index page says its topics were last active
+
+    Args:
+        link_list (list of dict): get_discussion_urls result, "link" and "last_update" per topic
+    """
+    for topic_info in link_list:
+        if topic_info.get("last_update") is not None and topic_info.get("link"):
+            _last_updates[topic_link(topic_info["link"])] = topic_info["last_update"].timestamp()
+
+
+def lookup(url):
+    """Cached entry of url
+
+    Returns:
+        (CachedPage or None when the cache is off or has no entry, conditional request
+        headers, whether the page can be used without asking the server)
+    """
+    if not CACHE_PATH:
+        return None, {}, False
+    row = _connection().execute(
+        f"SELECT etag, last_modified, digest, body, fetched_at FROM {PAGE_TABLE_NAME} WHERE url = (?)", (url,)
+    ).fetchone()
+    if row is None:
+        return None, {}, False
+    etag, last_modified, digest, body, fetched_at = row
+    page = CachedPage(url, zlib.decompress(body).decode(), digest, from_cache=True)
+
+    last_update = _last_updates.get(topic_link(url))
+    if last_update is not None:
+        fresh = fetched_at >= last_update
+    else:
+        fresh = time.time() - fetched_at < DEFAULT_TTL
+
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return page, headers, fresh
+
+
+def revalidated(page):
+    """The server answered 304, the cached page is current as of now"""
+    con = _connection()
+    con.execute(f"UPDATE {PAGE_TABLE_NAME} SET fetched_at = (?) WHERE url = (?)", (time.time(), page.url))
+    con.commit()
+    metrics.inc("http_cache_total", result="not_modified")
+    return page
+
+
+def store(url, text, headers):
+    """Keep a freshly downloaded page with the validators from its response headers"""
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    if CACHE_PATH:
+        con = _connection()
+        con.execute(
+            f"INSERT OR REPLACE INTO {PAGE_TABLE_NAME}(url, etag, last_modified, digest, body, fetched_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (url, headers.get("ETag"), headers.get("Last-Modified"), digest, zlib.compress(text.encode()), time.time()),
+        )
+        con.commit()
+        metrics.inc("http_cache_total", result="miss")
+    return CachedPage(url, text, digest)
+
+
+def get_parsed(parser, response):
+    """Parse result of an earlier identical body, None when it has to be parsed"""
+    digest = getattr(response, "digest", None)
+    if not CACHE_PATH or digest is None:
+        return None
+    row = _connection().execute(
+        f"SELECT data FROM {PARSED_TABLE_NAME} WHERE parser = (?) AND url = (?) AND digest = (?)",
+        (parser, response.url, digest),
+    ).fetchone()
+    if row is None:
+        return None
+    metrics.inc("http_cache_parsed_total", parser=parser)
+    return pickle.loads(row[0])
+
+
+def put_parsed(parser, response, result):
+    digest = getattr(response, "digest", None)
+    if not CACHE_PATH or digest is None:
+        return
+    con = _connection()
+    con.execute(
+        f"INSERT OR REPLACE INTO {PARSED_TABLE_NAME}(parser, url, digest, data) VALUES (?, ?, ?, ?)",
+        (parser, response.url, digest, pickle.dumps(result)),
+    )
+    con.commit()
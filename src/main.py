@@ -21,8 +21,14 @@ from alive_progress import alive_bar
 from retry import retry
 
 import emjr
+import http_cache
+import metrics
+import near_dup
+import shards
 import sql
-from toxicity_measure import count_then_measure_post
+import topology
+import toxicity_measure
+from url_index import KnownUrls
 
 logging.basicConfig(
      level=logging.WARNING,
@@ -34,11 +40,21 @@ logger.setLevel(logging.WARNING)
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
-SKIP_TOPICS = ('https://www.econjobrumors.com/topic/about-ejmr', 'https://www.econjobrumors.com/topic/request-a-thread-to-be-deleted-here')
+BASE_URL = os.environ.get('EJMR_BASE_URL', 'https://www.econjobrumors.com/') # set by shards.launch, e.g. to crawl a local test server
+SKIP_TOPICS = (f'{BASE_URL}topic/about-ejmr', f'{BASE_URL}topic/request-a-thread-to-be-deleted-here')
 
 
-def db_consumer(q: queue.Queue, stop_event: multiprocessing.Event, db_name:Union[str, ValueProxy], completed: ValueProxy, total: ValueProxy, current_text:ValueProxy):
+def db_consumer(q: queue.Queue, stop_event: multiprocessing.Event, db_name:Union[str, ValueProxy], completed: ValueProxy, total: ValueProxy, current_text:ValueProxy, metrics_path:str=None, metrics_interval:int=15, profile_path:str=None, score:bool=True, scorer:str="detoxify", scorer_options:dict=None, worker_settings:dict=None, near_duplicates:str=None, near_duplicate_threshold:float=near_dup.THRESHOLD, window_reduce:str=None):
     logger.debug(f"DB Consumer [{os.getpid()}] started")
+    if metrics_path:
+        metrics.start_exporter(metrics_path, metrics_interval)
+    if profile_path:
+        metrics.start_sampling_profiler(profile_path)
+    # thread counts and core pinning have to be in place before the model loads
+    topology.apply(worker_settings)
+    toxicity_measure.set_backend(scorer, **(scorer_options or {}))
+    if window_reduce:
+        toxicity_measure.WINDOW_REDUCE = window_reduce
 
     try:
         with sqlite3.connect(db_name.value, detect_types=sqlite3.PARSE_DECLTYPES) as con:
@@ -63,32 +79,46 @@ def db_consumer(q: queue.Queue, stop_event: multiprocessing.Event, db_name:Union
                     topic_author = post_dict_list[0].get("author").strip()
                     topic_author_id = sql.create_author(con, topic_author)
 
-                    for post_dict in post_dict_list:
+                    # the whole topic is scored in batched forward passes, ingest-only runs leave the scores NULL for backfill.py
+                    if score:
+                        measure = toxicity_measure.measure_posts
+                    else:
+                        measure = lambda contents: [dict.fromkeys(sql.SCORE_COLUMNS)] * len(contents)
+                    contents = [post_dict.get("post").strip() for post_dict in post_dict_list]
+                    if near_duplicates:
+                        toxicity_dicts, planned = near_dup.score_topic(con, contents, measure, near_duplicates, near_duplicate_threshold)
+                    else:
+                        toxicity_dicts, planned = measure(contents), None
+                    cluster_ids = []
+
+                    for i, (post_dict, toxicity_dict) in enumerate(zip(post_dict_list, toxicity_dicts)):
                         author_code = post_dict.get("author").strip()
                         post_content:str = post_dict.get("post").strip()
                         created_at = post_dict.get("created_at")
                         link = post_dict.get("url").strip()
-                        toxicity_dict = count_then_measure_post(post_content)
-                        author_id = sql.create_author(con, author_code)
-                        # print(topic_author, topic_author_id, topic_title, link)
-                        topic_id = sql.create_topic(
-                            con, topic_title, topic_author_id
-                        )
-                        topic_url_id = sql.create_topic_url(
-                            con, link, topic_author_id, topic_id
-                        )
-                        #  print("type", type(toxicity_dict["toxicity"].item()))
-                        sql.create_post(
-                            con, post_content, author_id, topic_id, topic_url_id, created_at,
-                            toxicity=toxicity_dict["toxicity"],
-                            severe_toxicity=toxicity_dict["severe_toxicity"],
-                            obscene=toxicity_dict["obscene"],
-                            identity_attack=toxicity_dict["identity_attack"],
-                            insult=toxicity_dict["insult"],
-                            threat=toxicity_dict["threat"],
-                            sexual_explicit=toxicity_dict["sexual_explicit"]
-
-                        )
+                        with metrics.timer("db_write"):
+                            author_id = sql.create_author(con, author_code)
+                            # print(topic_author, topic_author_id, topic_title, link)
+                            topic_id = sql.create_topic(
+                                con, topic_title, topic_author_id
+                            )
+                            topic_url_id = sql.create_topic_url(
+                                con, link, topic_author_id, topic_id
+                            )
+                            #  print("type", type(toxicity_dict["toxicity"].item()))
+                            post_id = sql.create_post(
+                                con, post_content, author_id, topic_id, topic_url_id, created_at,
+                                toxicity=toxicity_dict["toxicity"],
+                                severe_toxicity=toxicity_dict["severe_toxicity"],
+                                obscene=toxicity_dict["obscene"],
+                                identity_attack=toxicity_dict["identity_attack"],
+                                insult=toxicity_dict["insult"],
+                                threat=toxicity_dict["threat"],
+                                sexual_explicit=toxicity_dict["sexual_explicit"]
+
+                            )
+                            if planned:
+                                near_dup.record(con, post_id, planned[i], cluster_ids)
                         post_text = textwrap.shorten(
                             post_content, width=40, placeholder="..."
                         ).ljust(40)
@@ -104,10 +134,14 @@ def db_consumer(q: queue.Queue, stop_event: multiprocessing.Event, db_name:Union
                 except queue.Empty:
                     if stop_event.is_set():
                         logger.debug(f"DB Consumer [{os.getpid()}] is finished")
+                        if metrics_path:
+                            metrics.export(metrics_path)
                         return
     except Exception:
         logger.exception(f'DB Consumer [{os.getpid()}] failed')
-        db_consumer(q, stop_event, db_name, completed, total, current_text)
+        metrics.inc("consumer_restarts_total")
+        # the profiler keeps sampling this thread, don't start a second one
+        db_consumer(q, stop_event, db_name, completed, total, current_text, metrics_path, metrics_interval, score=score, scorer=scorer, scorer_options=scorer_options, worker_settings=worker_settings, near_duplicates=near_duplicates, near_duplicate_threshold=near_duplicate_threshold)
 
     logger.debug(f"DB Consumer [{os.getpid()}] Exiting")
 
@@ -117,29 +151,37 @@ def is_fresh(last_update:datetime.datetime, freshness:int):
     return divmod(duration_in_s, 3600)[0] <= freshness
 
 @retry(tries=3, delay=.1, backoff=1.5, jitter=(.1, 3), max_delay=30, logger=None)
-def scrape_index(index_url, q: queue.Queue, completed: ValueProxy, total: ValueProxy, db_name:Union[str, ValueProxy], freshness:ValueProxy, scraped_pages:ValueProxy):
+def scrape_index(index_url, q: queue.Queue, completed: ValueProxy, total: ValueProxy, known_urls: KnownUrls, freshness:ValueProxy, scraped_pages:ValueProxy, topic_shard:tuple=None):
     short_url = textwrap.shorten(
         index_url, width=20, placeholder="..."
     )
     logger.debug(f"Index Scraper [{os.getpid()}] started. Index: {short_url}")
     try:
-        with sqlite3.connect(db_name.value, detect_types=sqlite3.PARSE_DECLTYPES) as con:
-            for url_dict in emjr.get_discussion_urls(index_url):
-                if not sql.contains_url(con, url_dict["link"]) or is_fresh(url_dict['last_update'], freshness.value):
+        for url_dict in emjr.get_discussion_urls(index_url):
+            if topic_shard and not shards.owns_topic(url_dict["link"], *topic_shard):
+                continue
+            if known_urls.claim(url_dict["link"], url_dict.get('last_update'), lambda last_update: is_fresh(last_update, freshness.value)):
+                try:
                     topic_pages = emjr.collect_topic_posts(
-                        "https://www.econjobrumors.com/", url_dict["link"]
+                        BASE_URL, url_dict["link"]
                     )
+                except Exception:
+                    known_urls.release(url_dict["link"])
+                    raise
 
-                    logger.debug(f'Index scraper [{os.getpid()}] add {len(topic_pages)} new topics')
+                logger.debug(f'Index scraper [{os.getpid()}] add {len(topic_pages)} new topics')
 
-                    q.put(topic_pages)
-                    page_num = index_url.split('/')[-1]
-                    if page_num.isdigit() and scraped_pages.value < int(page_num):
-                        scraped_pages.value = int(page_num)
+                q.put(topic_pages)
+                known_urls.done(url_dict["link"])
+                metrics.inc("topics_queued_total")
+                page_num = index_url.split('/')[-1]
+                if page_num.isdigit() and scraped_pages.value < int(page_num):
+                    scraped_pages.value = int(page_num)
 
-                    total.value += 1
-                else:
-                    logger.debug(f'Skipping {url_dict["link"]}')
+                total.value += 1
+            else:
+                metrics.inc("topics_skipped_total")
+                logger.debug(f'Skipping {url_dict["link"]}')
 
     except Exception:
         logger.exception(f'Index scraper [{os.getpid()}] failed')
@@ -148,10 +190,14 @@ def scrape_index(index_url, q: queue.Queue, completed: ValueProxy, total: ValueP
         logger.debug(f"Index Scraper [{os.getpid()}] completed")
         completed.value += 1
 
-def _update_progress(all_complete:Event, completed: ValueProxy, total: ValueProxy, current_text:ValueProxy, scraped_pages:ValueProxy):
+def _update_progress(all_complete:Event, completed: ValueProxy, total: ValueProxy, current_text:ValueProxy, scraped_pages:ValueProxy, q:queue.Queue=None):
 
     while not all_complete.is_set():
         try:
+            if q is not None:
+                metrics.set_gauge("queue_depth", q.qsize(), queue="topics")
+            metrics.set_gauge("tasks_completed", completed.value)
+            metrics.set_gauge("tasks_total", total.value)
             complete_percent = str(round((completed.value/total.value) * 100, 1))+"%"
             msg = f"Progress: {complete_percent: <7} Pages Scraped: {str(scraped_pages.value): <6} "+current_text.value
 
@@ -170,16 +216,44 @@ if __name__ == "__main__":
     #######################
     # CHANGE THESE VALUES #
     #######################
-    START = 1
-    STOP = 15778
-    DB_NAME = r'C:\Users\15083\Documents\EMJR\all_posts_continued_1-4m.db'
+    START = int(os.environ.get('EJMR_START', 1))
+    STOP = int(os.environ.get('EJMR_STOP', 15778))
+    DB_NAME = os.environ.get('EJMR_DB_NAME', r'C:\Users\15083\Documents\EMJR\all_posts_continued_1-4m.db')
     FRESHNESS_AGE = 84 # The number in hours in the past a thread is considered fresh and should reevaluate
+    SCORE_ON_INGEST = True # False stores posts unscored, score them afterwards with backfill.py
+    HTTP_CACHE = 'http_cache.db' # Conditional-request page cache so refreshes only download changed pages, None to disable
+    FULL_TEXT_INDEX = True # keep the FTS5 index used by search.py in sync while ingesting
+    NEAR_DUPLICATES = None # 'reuse' copies scores from a near-identical earlier post instead of scoring it, 'cluster' only records cluster ids
+    NEAR_DUPLICATE_THRESHOLD = 0.9 # Estimated Jaccard similarity at which posts count as near duplicates
+    SCORER = os.environ.get('EJMR_SCORER', 'detoxify') # 'detoxify', 'quantized' (int8, CPU) or 'stand-in', compare them with scorers.py
+    WINDOW_REDUCE = 'max' # how the window scores of a post longer than the model limit combine, 'max' or 'mean'
+    SCORER_OPTIONS = {} # e.g. {'checkpoint': r'C:\models\multilingual.ckpt'}
+    METRICS_PATH = 'metrics_{pid}.prom' # Prometheus text file per process, end in .json for a JSON snapshot, None to disable
+    METRICS_INTERVAL = 15 # Seconds between metrics exports
+    TOPOLOGY = 'plan' # 'plan' splits the cores statically, 'auto' benchmarks a few splits first, or a topology.plan(...) dict
+    PIN_WORKERS = False # pin every DB consumer to its own cores (Linux only)
+    PROFILE_PATH = None # e.g. 'profile_{pid}.folded' to run the sampling profiler on the first DB consumer
+    SHARD = int(os.environ.get('EJMR_SHARD', 0)) # This node's shard, counting from 0
+    SHARDS = int(os.environ.get('EJMR_SHARDS', 1)) # Number of nodes sharing the crawl, merge their databases with shards.py
+    SHARD_BY = os.environ.get('EJMR_SHARD_BY', 'pages') # 'pages' splits START..STOP between nodes, 'topics' splits topic urls by hash
     #######################
 
+    topic_shard = None
+    if SHARDS > 1:
+        DB_NAME = shards.shard_db_name(DB_NAME, SHARD, SHARDS)
+        if SHARD_BY == 'pages':
+            START, STOP = shards.page_range(START, STOP, SHARD, SHARDS)
+        else:
+            topic_shard = (SHARD, SHARDS)
+        logger.info(f'Shard {SHARD + 1}/{SHARDS} by {SHARD_BY}: pages {START}-{STOP} into {DB_NAME}')
+
     #if os.path.exists(DB_NAME):
     #    os.remove(DB_NAME)
 
     emjr.logger.setLevel(logger.level)
+    http_cache.configure(HTTP_CACHE)
+    if METRICS_PATH:
+        metrics.start_exporter(METRICS_PATH, METRICS_INTERVAL)
     m = multiprocessing.Manager()
     q = m.Queue()
     scrapping_complete_event = m.Event()
@@ -190,22 +264,39 @@ if __name__ == "__main__":
     completed = m.Value('i', 0)
     freshness = m.Value('i', FRESHNESS_AGE)
 
+    with sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES) as con:
+        if not SCORE_ON_INGEST:
+            sql.allow_pending_scores(con)
+        if FULL_TEXT_INDEX:
+            sql.enable_fts(con)
+        if NEAR_DUPLICATES:
+            sql.enable_near_duplicates(con)
+        known_urls = KnownUrls.load(con)
+    logger.info(f'Loaded {len(known_urls)} known topic urls')
+
     all_complete = Event()
     scraper_futures = []
     db_consumers_futures = []
-    scrapers = max(1,round(os.cpu_count() * 1))
-    consumers = max(1,round(os.cpu_count() * .5))
+    if TOPOLOGY == 'auto':
+        plan = topology.auto_tune(scorer=SCORER, pin=PIN_WORKERS, scorer_options=SCORER_OPTIONS)
+    elif TOPOLOGY == 'plan':
+        plan = topology.plan(pin=PIN_WORKERS)
+    else:
+        plan = TOPOLOGY
+    logger.info(f'Topology: {plan}')
+    scrapers = plan['scrapers']
+    consumers = plan['consumers']
 
     pool_exe = ProcessPoolExecutor
     if os.name == 'nt':
         pool_exe = ThreadPoolExecutor
 
     with ThreadPoolExecutor(scrapers) as scrapper_executor, pool_exe(consumers) as consumers_executor:
-        prog_thread = threading.Thread(target=_update_progress, args=(all_complete, completed, total, current_text, scraped_pages), daemon=True)
+        prog_thread = threading.Thread(target=_update_progress, args=(all_complete, completed, total, current_text, scraped_pages, q), daemon=True)
         prog_thread.start()
 
         for i in range(consumers):
-            db_consumers_futures.append(consumers_executor.submit(db_consumer, q, scrapping_complete_event, db_name, completed, total, current_text))
+            db_consumers_futures.append(consumers_executor.submit(db_consumer, q, scrapping_complete_event, db_name, completed, total, current_text, METRICS_PATH, METRICS_INTERVAL, PROFILE_PATH if i == 0 else None, SCORE_ON_INGEST, SCORER, SCORER_OPTIONS, topology.worker_settings(plan, i), NEAR_DUPLICATES, NEAR_DUPLICATE_THRESHOLD, WINDOW_REDUCE))
 
         try:
             db_consumers_futures[0].result(timeout=2)
@@ -215,11 +306,11 @@ if __name__ == "__main__":
 
         for i in range(START, STOP + 1):
             if i == 1:
-                url = "https://www.econjobrumors.com/"
+                url = BASE_URL
             else:
-                url = f"https://www.econjobrumors.com/page/{i}"
+                url = f"{BASE_URL}page/{i}"
 
-            scraper_futures.append(scrapper_executor.submit(scrape_index, url, q, completed, total, db_name, freshness, scraped_pages))
+            scraper_futures.append(scrapper_executor.submit(scrape_index, url, q, completed, total, known_urls, freshness, scraped_pages, topic_shard))
 
         try:
             scraper_futures[0].result(timeout=2)
@@ -254,4 +345,5 @@ if __name__ == "__main__":
             all_complete.set()
         except KeyboardInterrupt:
             pass
+    metrics.stop_exporter()
     logger.debug('Application complete')
\ No newline at end of file
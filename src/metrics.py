@@ -0,0 +1,232 @@
+"""Per-stage runtime metrics for the crawler
+
+Histograms, counters and gauges kept per process, exported on an interval to a
+Prometheus text file (anything not ending in .json) or a JSON snapshot. A path may
+contain {pid} so every consumer process writes its own file.
+
+example:
+    with metrics.timer("html_parse", page="topic"):
+        soup = BeautifulSoup(html_content, 'html.parser')
+    metrics.inc("get_fallback_total", to="tor")
+    metrics.start_exporter("metrics_{pid}.prom", interval=15)
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_exporter = None
+
+
+def _after_fork_in_child():
+    # a fork taken while another thread held _lock would leave it locked forever in
+    # the child, and the parent's values are not the child's to report under its pid
+    global _lock
+    _lock = threading.Lock()
+    _histograms.clear()
+    _counters.clear()
+    _gauges.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def snapshot():
+    """All metrics of this process as a JSON-serialisable dict"""
+    with _lock:
+        return {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "histograms": [
+                {"name": name, "labels": dict(labels), "count": h["count"], "sum": h["sum"],
+                 "buckets": dict(zip(map(str, BUCKETS), h["buckets"]))}
+                for (name, labels), h in _histograms.items()
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in _counters.items()
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in _gauges.items()
+            ],
+        }
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def to_prometheus():
+    """All metrics of this process in the Prometheus text exposition format"""
+    pid = str(os.getpid())
+    lines = []
+    typed = set()
+
+    def _type(metric, kind):
+        # one TYPE line per metric family, however many label sets it has
+        if metric not in typed:
+            typed.add(metric)
+            lines.append(f"# TYPE {metric} {kind}")
+
+    with _lock:
+        for (name, labels), h in sorted(_histograms.items()):
+            labels = dict(labels, pid=pid)
+            _type(f"ejmr_{name}_seconds", "histogram")
+            for bound, count in zip(BUCKETS, h["buckets"]):
+                lines.append(f"ejmr_{name}_seconds_bucket{_format_labels(labels, le=bound)} {count}")
+            lines.append(f'ejmr_{name}_seconds_bucket{_format_labels(labels, le="+Inf")} {h["count"]}')
+            lines.append(f"ejmr_{name}_seconds_sum{_format_labels(labels)} {h['sum']}")
+            lines.append(f"ejmr_{name}_seconds_count{_format_labels(labels)} {h['count']}")
+        for (name, labels), value in sorted(_counters.items()):
+            _type(f"ejmr_{name}", "counter")
+            lines.append(f"ejmr_{name}{_format_labels(dict(labels, pid=pid))} {value}")
+        for (name, labels), value in sorted(_gauges.items()):
+            _type(f"ejmr_{name}", "gauge")
+            lines.append(f"ejmr_{name}{_format_labels(dict(labels, pid=pid))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export(path):
+    path = path.format(pid=os.getpid())
+    text = json.dumps(snapshot(), indent=2) if path.endswith(".json") else to_prometheus()
+    # write then rename so a scraper never reads a half written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def start_exporter(path, interval=15):
+    """Export this process' metrics to path every interval seconds, once per process"""
+    global _exporter
+    if _exporter is not None and _exporter[0] == os.getpid():
+        return
+    stop = threading.Event()
+
+    def _run():
+        while not stop.wait(interval):
+            try:
+                export(path)
+            except Exception:
+                logger.exception("Metrics export failed")
+        export(path)
+
+    thread = threading.Thread(target=_run, daemon=True, name="metrics-exporter")
+    _exporter = (os.getpid(), stop, thread)
+    thread.start()
+
+
+def stop_exporter():
+    global _exporter
+    if _exporter is not None and _exporter[0] == os.getpid():
+        _exporter[1].set()
+        _exporter[2].join()
+    _exporter = None
+
+
+def start_sampling_profiler(path, interval=0.005, thread_id=None, flush_every=30):
+    """Sample one thread's stack every interval seconds into a folded-stack file
+
+    The output (one "frame;frame;frame count" line per stack) loads directly into
+    flamegraph.pl or speedscope. Off by default, switch it on for a single worker.
+
+    Args:
+        path (str): output file, may contain {pid}
+        interval (float): seconds between samples
+        thread_id (int): thread to sample, defaults to the calling thread
+        flush_every (float): seconds between rewrites of the output file
+
+    Returns:
+        threading.Event, set it to stop sampling and write the file a final time
+    """
+    path = path.format(pid=os.getpid())
+    thread_id = thread_id or threading.get_ident()
+    stacks = Counter()
+    stop = threading.Event()
+
+    def _flush():
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def _run():
+        last_flush = time.monotonic()
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+            if time.monotonic() - last_flush >= flush_every:
+                _flush()
+                last_flush = time.monotonic()
+        _flush()
+
+    threading.Thread(target=_run, daemon=True, name="sampling-profiler").start()
+    return stop
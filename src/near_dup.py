@@ -0,0 +1,191 @@
+"""MinHash / LSH near-duplicate detection for quoted and reposted text
+
+Each post gets a MinHash signature over word 3-grams of its normalized text. The
+signature is cut into BANDS bands of ROWS values; posts sharing any band bucket are
+candidates, and the share of equal signature values estimates their Jaccard
+similarity. Signatures and band buckets live in the database (sql.py) so every DB
+consumer process, and every later run, sees the same index.
+"""
+import re
+import zlib
+
+from collections import deque
+
+import numpy as np
+
+import metrics
+import sql
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+THRESHOLD = 0.9 # estimated Jaccard similarity at which a post counts as a near duplicate
+MAX_CANDIDATES = 200
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(20180101)  # fixed so signatures stay comparable between runs
+_A = _rng.randint(1, _PRIME, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, NUM_PERM).astype(np.uint64)
+
+
+def normalize(text):
+    """Lowercase words only, so whitespace, punctuation and quoting markup don't matter"""
+    return re.findall(r"\w+", text.lower())
+
+
+def signature(text):
+    """MinHash signature of a post as a numpy array of NUM_PERM integers
+
+    None for posts without words (empty, emoji or punctuation only), which would all
+    get the same signature and so match each other.
+    """
+    words = normalize(text)
+    if not words:
+        return None
+    if len(words) < SHINGLE_WORDS:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+    hashes = np.fromiter((zlib.crc32(s.encode()) for s in set(shingles)), dtype=np.uint64)
+    hashes %= np.uint64(_PRIME)
+    return ((np.outer(hashes, _A) + _B) % np.uint64(_PRIME)).min(axis=0)
+
+
+def band_buckets(sig):
+    """(band, bucket) pairs of a signature for the LSH table"""
+    return [
+        (band, zlib.crc32(sig[band * ROWS:(band + 1) * ROWS].tobytes()))
+        for band in range(BANDS)
+    ]
+
+
+def similarity(sig_a, sig_b):
+    return float(np.mean(sig_a == sig_b))
+
+
+def to_blob(sig):
+    return sig.astype(np.uint32).tobytes()
+
+
+def from_blob(blob):
+    return np.frombuffer(blob, dtype=np.uint32).astype(np.uint64)
+
+
+def nearest(con, sig, threshold=THRESHOLD):
+    """Most similar stored post at or above threshold
+
+    Returns:
+        (post id, similarity) or None
+    """
+    best = None
+    for post_id, blob in sql.get_minhash_candidates(con, band_buckets(sig), MAX_CANDIDATES):
+        sim = similarity(sig, from_blob(blob))
+        if sim >= threshold and (best is None or sim > best[1]):
+            best = (post_id, sim)
+    return best
+
+
+def plan_topic(con, contents, threshold=THRESHOLD):
+    """Signatures of a topic's posts and the neighbor each one can take its scores from
+
+    Earlier posts of the same topic are checked before the database, so a post quoted
+    further down its own thread is caught too.
+
+    Returns:
+        list of (signature, neighbor) where neighbor is None, ("db", post id) or
+        ("batch", index of an earlier post in contents)
+    """
+    planned = []
+    batch_buckets = {}  # (band, bucket) -> indices of earlier posts, the in-memory twin of the LSH table
+    for i, content in enumerate(contents):
+        sig = signature(content)
+        neighbor = None
+        if sig is None:
+            planned.append((sig, neighbor))
+            continue
+        buckets = band_buckets(sig)
+        candidates = set()
+        for key in buckets:
+            candidates.update(batch_buckets.get(key, ()))
+        best_sim = threshold
+        # newest first and capped, like get_minhash_candidates
+        for j in sorted(candidates, reverse=True)[:MAX_CANDIDATES]:
+            sim = similarity(sig, planned[j][0])
+            if sim > best_sim or (sim == best_sim and neighbor is None):
+                neighbor, best_sim = ("batch", j), sim
+                if sim == 1.0:
+                    break
+        for key in buckets:
+            batch_buckets.setdefault(key, deque(maxlen=MAX_CANDIDATES)).append(i)
+        if neighbor is None:
+            found = nearest(con, sig, threshold)
+            if found:
+                neighbor = ("db", found[0])
+        planned.append((sig, neighbor))
+    return planned
+
+
+def score_topic(con, contents, measure, mode="reuse", threshold=THRESHOLD):
+    """Scores for a topic's posts, reusing a near-identical neighbor's scores when allowed
+
+    Args:
+        con: sqlite connection
+        contents (list of str): post texts of one topic
+        measure (callable): scores a list of texts, e.g. toxicity_measure.measure_posts
+        mode (str): "reuse" to skip the model for near duplicates, "cluster" to only record clusters
+        threshold (float): minimum estimated similarity of a near duplicate
+
+    Returns:
+        (list of score dictionaries, plan from plan_topic for record())
+    """
+    planned = plan_topic(con, contents, threshold)
+    scores = [None] * len(contents)
+    if mode == "reuse":
+        for i, (_, neighbor) in enumerate(planned):
+            if neighbor and neighbor[0] == "db":
+                # None while the neighbor itself waits for scores, it is measured then
+                scores[i] = sql.get_post_scores(con, neighbor[1])
+
+    def _reused_from_batch(i):
+        neighbor = planned[i][1]
+        return mode == "reuse" and neighbor and neighbor[0] == "batch"
+
+    to_score = [i for i in range(len(contents)) if scores[i] is None and not _reused_from_batch(i)]
+    if to_score:
+        for i, toxicity_dict in zip(to_score, measure([contents[i] for i in to_score])):
+            scores[i] = toxicity_dict
+    for i in range(len(contents)):
+        if scores[i] is None:
+            # batch neighbors always come earlier, so their scores are already filled in
+            scores[i] = scores[planned[i][1][1]]
+    metrics.inc("near_duplicate_reused_total", len(contents) - len(to_score))
+    return scores, planned
+
+
+def record(con, post_id, planned, cluster_ids):
+    """Store a written post's signature and cluster id
+
+    Args:
+        con: sqlite connection
+        post_id (int): id from sql.create_post
+        planned (tuple): this post's (signature, neighbor) from plan_topic
+        cluster_ids (list): cluster ids of the topic's earlier posts, the new one is appended
+
+    Returns:
+        cluster id, the id of the first post of the cluster
+    """
+    sig, neighbor = planned
+    if neighbor is None:
+        cluster_id = post_id
+    elif neighbor[0] == "batch":
+        cluster_id = cluster_ids[neighbor[1]]
+    else:
+        cluster_id = sql.get_post_cluster(con, neighbor[1])
+    if sig is None:
+        # a post without words is its own cluster and never a candidate
+        sql.record_minhash(con, post_id, None, [], cluster_id)
+    else:
+        sql.record_minhash(con, post_id, to_blob(sig), band_buckets(sig), cluster_id)
+    cluster_ids.append(cluster_id)
+    return cluster_id
@@ -0,0 +1,150 @@
+"""Scorer backends behind toxicity_measure
+
+Every backend looks like a Detoxify model: predict() takes a string or a list of
+strings and returns {label: score} or {label: [scores]}, and a `tokenizer` attribute
+is used for window splitting when present.
+
+    detoxify    full precision PyTorch Detoxify('multilingual'), the reference
+    quantized   Detoxify with its Linear layers dynamically quantized to int8 for CPU,
+                optionally loaded from a local checkpoint
+    stand-in    deterministic hash based scores, no model, for tests and benchmarks
+
+Compare backends on a local validation set (one post per line, or a sample of a
+database written by main.py):
+    python scorers.py posts.txt --backends=quantized,stand-in
+    python scorers.py --db_name=all_posts.db --sample=2000
+"""
+import hashlib
+import json
+import sqlite3
+import time
+
+import fire
+import numpy as np
+
+import sql
+
+
+def load_detoxify(model_type='multilingual', checkpoint=None, device='cpu'):
+    from detoxify import Detoxify
+    return Detoxify(model_type, checkpoint=checkpoint, device=device)
+
+
+def load_quantized(model_type='multilingual', checkpoint=None):
+    """Detoxify with dynamic int8 quantization of every Linear layer, CPU only"""
+    import torch
+    detox = load_detoxify(model_type, checkpoint, 'cpu')
+    detox.model = torch.quantization.quantize_dynamic(detox.model, {torch.nn.Linear}, dtype=torch.qint8)
+    return detox
+
+
+class StandInDetoxify:
+    """Deterministic Detoxify replacement, scores are derived from a hash of the text"""
+
+    tokenizer = None
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def _scores(self, text):
+        digest = hashlib.sha256(text.encode()).digest()
+        return [digest[i] / 255 for i in range(len(sql.SCORE_COLUMNS))]
+
+    def predict(self, text):
+        # same shapes as Detoxify: numpy scalars for one text, lists of floats for many
+        if self.delay:
+            time.sleep(self.delay)
+        if isinstance(text, str):
+            return {label: np.float64(score) for label, score in zip(sql.SCORE_COLUMNS, self._scores(text))}
+        scores = [self._scores(t) for t in text]
+        return {label: [s[i] for s in scores] for i, label in enumerate(sql.SCORE_COLUMNS)}
+
+
+BACKENDS = {
+    "detoxify": load_detoxify,
+    "quantized": load_quantized,
+    "stand-in": StandInDetoxify,
+}
+
+
+def load_backend(name, **options):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown scorer backend {name!r}, choose from {', '.join(BACKENDS)}")
+    return BACKENDS[name](**options)
+
+
+def _validation_posts(validation_path=None, db_name=None, sample=1000):
+    if validation_path:
+        with open(validation_path, encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()][:sample]
+    with sqlite3.connect(db_name) as con:
+        sql.set_up(con)
+        return [
+            row[0] for row in con.execute(
+                f"SELECT content FROM {sql.POST_TABLE_NAME} ORDER BY random() LIMIT (?)", (sample,)
+            )
+        ]
+
+
+def evaluate(validation_path=None, db_name=None, backends="detoxify,quantized", reference="detoxify",
+             sample=1000, batch_size=64, checkpoint=None, out=None):
+    """Latency and agreement with the reference backend on a local validation set
+
+    Args:
+        validation_path (str): text file with one post per line
+        db_name (str): database to sample posts from when no validation_path is given
+        backends (str or tuple): backends to compare, comma separated
+        reference (str): backend the others are compared against
+        sample (int): maximum number of posts used
+        batch_size (int): windows per forward pass
+        checkpoint (str): local checkpoint for the detoxify and quantized backends
+        out (str): optional JSON results path
+
+    Returns:
+        dict of backend name to {posts_per_s, p50_batch_ms, mean_abs_diff, label_agreement}
+    """
+    import toxicity_measure
+
+    if isinstance(backends, str):
+        backends = backends.split(",")
+    posts = _validation_posts(validation_path, db_name, sample)
+    names = [reference] + [name for name in backends if name != reference]
+
+    scores = {}
+    results = {}
+    for name in names:
+        options = {"checkpoint": checkpoint} if checkpoint and name in ("detoxify", "quantized") else {}
+        toxicity_measure.set_backend(name, **options)
+        # load (and for quantized, quantize) the model and warm up outside the timed loop
+        toxicity_measure.get_detox()
+        toxicity_measure.measure_posts(posts[:batch_size], batch_size)
+        latencies = []
+        scores[name] = []
+        start = time.perf_counter()
+        for i in range(0, len(posts), batch_size):
+            t = time.perf_counter()
+            scores[name].extend(toxicity_measure.measure_posts(posts[i:i + batch_size], batch_size))
+            latencies.append(time.perf_counter() - t)
+        wall = time.perf_counter() - start
+
+        reference_scores = scores[reference]
+        diffs = [abs(a[label] - b[label]) for a, b in zip(scores[name], reference_scores) for label in sql.SCORE_COLUMNS]
+        agree = [
+            (a["toxicity"] >= 0.5) == (b["toxicity"] >= 0.5) for a, b in zip(scores[name], reference_scores)
+        ]
+        results[name] = {
+            "posts": len(posts),
+            "posts_per_s": round(len(posts) / wall, 2) if wall else None,
+            "p50_batch_ms": round(float(np.percentile(latencies, 50)) * 1000, 3) if latencies else None,
+            "mean_abs_diff": round(float(np.mean(diffs)), 5) if diffs else None,
+            "label_agreement": round(float(np.mean(agree)), 5) if agree else None,
+        }
+
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    fire.Fire(evaluate)
@@ -0,0 +1,52 @@
+"""Full-text search over post content and topic titles
+
+Queries use the SQLite FTS5 syntax: words, "quoted phrases", prefix*, AND / OR / NOT.
+
+example:
+    python search.py build all_posts.db
+    python search.py posts all_posts.db '"job market" harvard' --limit=20
+    python search.py toxicity all_posts.db 'chicago OR booth'
+    python search.py topics all_posts.db 'placement*'
+"""
+import sqlite3
+
+import fire
+
+import sql
+
+
+def _connect(db_name):
+    return sqlite3.connect(db_name, detect_types=sqlite3.PARSE_DECLTYPES)
+
+
+def build(db_name, rebuild=False):
+    """Create the full-text indexes and index every existing post and topic
+
+    Args:
+        db_name (str): sqlite database written by main.py
+        rebuild (bool): reindex from scratch even when the indexes already exist
+    """
+    with _connect(db_name) as con:
+        return sql.enable_fts(con, rebuild)
+
+
+def posts(db_name, query, limit=100, order="rank"):
+    """Matching posts with their toxicity scores, authors and topics"""
+    with _connect(db_name) as con:
+        return list(sql.search_posts(con, query, limit, order))
+
+
+def topics(db_name, query, limit=100):
+    """Topics whose title matches"""
+    with _connect(db_name) as con:
+        return sql.search_topics(con, query, limit)
+
+
+def toxicity(db_name, *queries, threshold=0.5):
+    """Post count, toxic share and mean scores of the posts matching each query"""
+    with _connect(db_name) as con:
+        return [sql.term_toxicity(con, query, threshold) for query in queries]
+
+
+if __name__ == "__main__":
+    fire.Fire({"build": build, "posts": posts, "topics": topics, "toxicity": toxicity})
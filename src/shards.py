@@ -0,0 +1,248 @@
+"""Sharded crawls: split the work between nodes, then merge the shard databases
+
+Every node runs main.py with EJMR_SHARD / EJMR_SHARDS (and optionally EJMR_SHARD_BY)
+set. It writes to its own shard database, e.g. all_posts.shard0of4.db, with the usual
+sql.py schema. Once every node is done, merge combines the shards into one database.
+AUTHOR, TOPIC and TOPIC_URL ids are remapped, posts stored by more than one shard are
+kept once, and the secondary indexes are rebuilt in bulk at the end.
+
+example:
+    EJMR_SHARD=0 EJMR_SHARDS=4 python main.py    # on node 0, and so on
+    python shards.py merge all_posts.db all_posts.shard0of4.db all_posts.shard1of4.db ...
+    python shards.py launch 4 --db_name=x.db      # every shard as a local process, then merge
+"""
+import logging
+import os
+import sqlite3
+import subprocess
+import sys
+import zlib
+
+import fire
+
+import sql
+
+logging.basicConfig(
+     level=logging.INFO,
+     format= '[%(asctime)s] %(levelname)s - %(message)s',
+     datefmt='%H:%M:%S'
+ )
+logger = logging.getLogger(__name__)
+
+
+def shard_db_name(db_name, shard, shards):
+    root, ext = os.path.splitext(db_name)
+    return f"{root}.shard{shard}of{shards}{ext or '.db'}"
+
+
+def page_range(start, stop, shard, shards):
+    """Contiguous slice of the index pages start..stop owned by shard, sizes differ by at most one"""
+    pages = stop - start + 1
+    if shards > pages:
+        raise ValueError(f"{shards} shards for {pages} index pages, some shards would have nothing to crawl")
+    size, extra = divmod(pages, shards)
+    first = start + shard * size + min(shard, extra)
+    return first, first + size - 1 + (shard < extra)
+
+
+def owns_topic(link, shard, shards):
+    """Whether shard scrapes the topic at link when sharding by topic url hash"""
+    return zlib.crc32(link.encode()) % shards == shard
+
+
+def _columns(con, schema, table):
+    return [row[1] for row in con.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
+def _has_table(con, schema, table):
+    return bool(con.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name=(?)", (table,)
+    ).fetchone())
+
+
+def _merge_shard(con, shard_db):
+    """Copy one shard into the attached target, returns (posts read, posts added)"""
+    con.execute("ATTACH DATABASE (?) AS shard", (shard_db,))
+    try:
+        post_columns = _columns(con, "shard", sql.POST_TABLE_NAME)
+        cluster = "s.cluster_id" if "cluster_id" in post_columns else "NULL"
+        scores = ", ".join(sql.SCORE_COLUMNS)
+        cur = con.cursor()
+
+        cur.execute(f"INSERT OR IGNORE INTO main.{sql.AUTHOR_TABLE_NAME}(code) SELECT code FROM shard.{sql.AUTHOR_TABLE_NAME}")
+        cur.execute(
+            f"CREATE TEMP TABLE author_map AS SELECT s.id AS src_id, m.id AS dst_id"
+            f" FROM shard.{sql.AUTHOR_TABLE_NAME} s JOIN main.{sql.AUTHOR_TABLE_NAME} m ON m.code = s.code"
+        )
+        cur.execute(
+            f"INSERT OR IGNORE INTO main.{sql.TOPIC_TABLE_NAME}(title, author_id)"
+            f" SELECT s.title, a.dst_id FROM shard.{sql.TOPIC_TABLE_NAME} s JOIN author_map a ON a.src_id = s.author_id"
+        )
+        cur.execute(
+            f"CREATE TEMP TABLE topic_map AS SELECT s.id AS src_id, m.id AS dst_id"
+            f" FROM shard.{sql.TOPIC_TABLE_NAME} s JOIN author_map a ON a.src_id = s.author_id"
+            f" JOIN main.{sql.TOPIC_TABLE_NAME} m ON m.title = s.title AND m.author_id = a.dst_id"
+        )
+        cur.execute(
+            f"INSERT OR IGNORE INTO main.{sql.TOPIC_URL_TABLE_NAME}(link, author_id, topic_id)"
+            f" SELECT s.link, a.dst_id, t.dst_id FROM shard.{sql.TOPIC_URL_TABLE_NAME} s"
+            f" JOIN author_map a ON a.src_id = s.author_id JOIN topic_map t ON t.src_id = s.topic_id"
+        )
+        cur.execute(
+            f"CREATE TEMP TABLE topic_url_map AS SELECT s.id AS src_id, m.id AS dst_id"
+            f" FROM shard.{sql.TOPIC_URL_TABLE_NAME} s JOIN main.{sql.TOPIC_URL_TABLE_NAME} m ON m.link = s.link"
+        )
+
+        # one row per distinct post of the shard, already in target ids
+        cur.execute(
+            "CREATE TEMP TABLE post_src AS SELECT MIN(s.id) AS src_id, s.content, a.dst_id AS author_id,"
+            " t.dst_id AS topic_id, u.dst_id AS topic_url_id, MIN(s.created_at) AS created_at,"
+            + ", ".join(f" MAX(s.{score}) AS {score}" for score in sql.SCORE_COLUMNS) +
+            f", MIN({cluster}) AS cluster_id"
+            f" FROM shard.{sql.POST_TABLE_NAME} s JOIN author_map a ON a.src_id = s.author_id"
+            f" JOIN topic_map t ON t.src_id = s.topic_id JOIN topic_url_map u ON u.src_id = s.topic_url_id"
+            " GROUP BY s.content, a.dst_id, t.dst_id, u.dst_id"
+        )
+        read = cur.execute("SELECT COUNT(*) FROM post_src").fetchone()[0]
+        before = cur.execute(f"SELECT COUNT(*) FROM main.{sql.POST_TABLE_NAME}").fetchone()[0]
+        cur.execute(
+            f"INSERT INTO main.{sql.POST_TABLE_NAME}(content, author_id, topic_id, topic_url_id, created_at, {scores})"
+            f" SELECT content, author_id, topic_id, topic_url_id, created_at, {scores} FROM post_src p"
+            f" WHERE NOT EXISTS (SELECT 1 FROM main.{sql.POST_TABLE_NAME} m WHERE m.topic_url_id = p.topic_url_id"
+            " AND m.content = p.content AND m.author_id = p.author_id AND m.topic_id = p.topic_id)"
+            " ORDER BY src_id"
+        )
+        added = cur.execute(f"SELECT COUNT(*) FROM main.{sql.POST_TABLE_NAME}").fetchone()[0] - before
+        cur.execute(
+            f"CREATE TEMP TABLE post_map AS SELECT p.src_id, MIN(m.id) AS dst_id, p.cluster_id"
+            f" FROM post_src p JOIN main.{sql.POST_TABLE_NAME} m ON m.topic_url_id = p.topic_url_id"
+            " AND m.content = p.content AND m.author_id = p.author_id AND m.topic_id = p.topic_id"
+            " GROUP BY p.src_id"
+        )
+        # a post another shard stored unscored takes this shard's scores
+        cur.execute(
+            f"UPDATE main.{sql.POST_TABLE_NAME} SET ({scores}) = (SELECT {scores} FROM post_src p"
+            f" JOIN post_map pm ON pm.src_id = p.src_id WHERE pm.dst_id = {sql.POST_TABLE_NAME}.id)"
+            f" WHERE toxicity IS NULL AND id IN (SELECT pm.dst_id FROM post_map pm JOIN post_src p"
+            " ON p.src_id = pm.src_id WHERE p.toxicity IS NOT NULL)"
+        )
+
+        if _has_table(con, "shard", sql.MINHASH_TABLE_NAME):
+            # cluster ids are post ids of the shard, so they are remapped like the posts
+            cur.execute(
+                f"UPDATE main.{sql.POST_TABLE_NAME} SET cluster_id = (SELECT c.dst_id FROM post_map pm"
+                f" JOIN post_map c ON c.src_id = pm.cluster_id WHERE pm.dst_id = {sql.POST_TABLE_NAME}.id)"
+                f" WHERE cluster_id IS NULL AND id IN (SELECT dst_id FROM post_map)"
+            )
+            # buckets first, only for posts the target has no signature for yet
+            cur.execute(
+                f"INSERT INTO main.{sql.LSH_TABLE_NAME}(band, bucket, post_id)"
+                f" SELECT s.band, s.bucket, pm.dst_id FROM shard.{sql.LSH_TABLE_NAME} s JOIN post_map pm ON pm.src_id = s.post_id"
+                f" WHERE pm.dst_id NOT IN (SELECT post_id FROM main.{sql.MINHASH_TABLE_NAME})"
+            )
+            cur.execute(
+                f"INSERT OR IGNORE INTO main.{sql.MINHASH_TABLE_NAME}(post_id, signature)"
+                f" SELECT pm.dst_id, s.signature FROM shard.{sql.MINHASH_TABLE_NAME} s JOIN post_map pm ON pm.src_id = s.post_id"
+            )
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        for table in ("author_map", "topic_map", "topic_url_map", "post_src", "post_map"):
+            con.execute(f"DROP TABLE IF EXISTS temp.{table}")
+        con.commit()
+        con.execute("DETACH DATABASE shard")
+    return read, added
+
+
+def merge(target_db, *shard_dbs):
+    """Merge shard databases into target_db, which may already hold posts
+
+    Args:
+        target_db (str): database to merge into, created when missing
+        shard_dbs (str): shard databases written by main.py
+
+    Returns:
+        number of posts added to target_db
+    """
+    with sqlite3.connect(target_db, detect_types=sqlite3.PARSE_DECLTYPES) as con:
+        sql.allow_pending_scores(con)
+
+        fts = sql.checkTableExists(con, sql.POST_FTS_TABLE_NAME)
+        near_duplicates = sql.checkTableExists(con, sql.MINHASH_TABLE_NAME)
+        for shard_db in shard_dbs:
+            if not os.path.exists(shard_db):
+                raise FileNotFoundError(shard_db)
+            with sqlite3.connect(shard_db) as shard_con:
+                fts = fts or sql.checkTableExists(shard_con, sql.POST_FTS_TABLE_NAME)
+                near_duplicates = near_duplicates or sql.checkTableExists(shard_con, sql.MINHASH_TABLE_NAME)
+        if near_duplicates:
+            sql.enable_near_duplicates(con)
+
+        # per-row index and trigger upkeep is what makes a bulk insert slow, rebuild them once at the end
+        sql.drop_secondary_indexes(con)
+        if fts:
+            sql.disable_fts(con)
+        # ids that dedupe posts need an index on the target
+        con.execute(f"CREATE INDEX IF NOT EXISTS post_topic_url ON {sql.POST_TABLE_NAME} (topic_url_id)")
+
+        added = 0
+        for shard_db in shard_dbs:
+            read, shard_added = _merge_shard(con, shard_db)
+            added += shard_added
+            logger.info(f"Merged {shard_db}: {read} posts, {shard_added} new")
+
+        con.execute("DROP INDEX IF EXISTS post_topic_url")
+        sql.allow_pending_scores(con)
+        if near_duplicates:
+            sql.enable_near_duplicates(con)
+        if fts:
+            sql.enable_fts(con, rebuild=True)
+        con.commit()
+    return added
+
+
+def launch(shards, db_name=None, by="pages", merge_into=None, base_url=None, start=None, stop=None, scorer=None):
+    """Run every shard of main.py as a local process, then merge them
+
+    Settings that are given override main.py's for every shard, through the same
+    EJMR_* environment variables a node would set.
+
+    Args:
+        shards (int): number of shards
+        db_name (str): DB_NAME for main.py, also where the shard databases are looked for when merging
+        by (str): "pages" or "topics"
+        merge_into (str): merge target, defaults to db_name
+        base_url (str): site to crawl, e.g. a benchmark.serve server
+        start (int): first index page
+        stop (int): last index page
+        scorer (str): scorer backend, see scorers.BACKENDS
+
+    Returns:
+        number of posts merged, None when the shards were not merged
+    """
+    if shards < 2:
+        # main.py only writes to a shard database when EJMR_SHARDS > 1, run it directly instead
+        raise ValueError(f"launch needs at least 2 shards, not {shards}")
+    if by == "pages" and start is not None and stop is not None:
+        page_range(start, stop, 0, shards)  # fail before starting any process
+    env = dict(os.environ, EJMR_SHARDS=str(shards), EJMR_SHARD_BY=by)
+    settings = {"EJMR_DB_NAME": db_name, "EJMR_BASE_URL": base_url, "EJMR_START": start, "EJMR_STOP": stop, "EJMR_SCORER": scorer}
+    env.update((name, str(value)) for name, value in settings.items() if value is not None)
+
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    processes = [
+        subprocess.Popen([sys.executable, main_py], env=dict(env, EJMR_SHARD=str(shard)))
+        for shard in range(shards)
+    ]
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, not merging")
+    if not db_name:
+        return None
+    return merge(merge_into or db_name, *(shard_db_name(db_name, shard, shards) for shard in range(shards)))
+
+
+if __name__ == "__main__":
+    fire.Fire({"merge": merge, "launch": launch})
@@ -7,6 +7,11 @@ AUTHOR_TABLE_NAME = "AUTHOR"
 TOPIC_TABLE_NAME = "TOPIC"
 TOPIC_URL_TABLE_NAME = "TOPIC_URL"
 POST_TABLE_NAME = "POST"
+POST_FTS_TABLE_NAME = "POST_FTS"
+TOPIC_FTS_TABLE_NAME = "TOPIC_FTS"
+MINHASH_TABLE_NAME = "POST_MINHASH"
+LSH_TABLE_NAME = "POST_LSH"
+SCORE_COLUMNS = ("toxicity", "severe_toxicity", "obscene", "identity_attack", "insult", "threat", "sexual_explicit")
 
 
 @retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
@@ -66,26 +71,61 @@ def set_up(con):
         )
     if not checkTableExists(con, POST_TABLE_NAME):
 
-        # create table POST
-        cur.execute(
-            f"CREATE TABLE {POST_TABLE_NAME} ("
-            "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
-            "content TEXT VARCHAR2(5000) NOT NULL,"
-            "author_id INTEGER NOT NULL,"
-            "topic_id INTEGER NOT NULL,"
-            "topic_url_id INTEGER NOT NULL,"
-            "created_at timestamp NOT NULL,"
-            "toxicity DOUBLE NOT NULL,"
-            "severe_toxicity DOUBLE NOT NULL,"
-            "obscene DOUBLE NOT NULL,"
-            "identity_attack DOUBLE NOT NULL,"
-            "insult DOUBLE NOT NULL,"
-            "threat DOUBLE NOT NULL,"
-            "sexual_explicit DOUBLE NOT NULL,"
-            f"FOREIGN KEY (author_id) REFERENCES {AUTHOR_TABLE_NAME} (id),"
-            f"FOREIGN KEY (topic_id) REFERENCES {TOPIC_TABLE_NAME} (id),"
-            f"FOREIGN KEY (topic_url_id) REFERENCES {TOPIC_URL_TABLE_NAME} (id))"
-        )
+        # create table POST, scores stay NULL until scored so posts can be stored first
+        cur.execute(_post_table_sql(POST_TABLE_NAME))
+
+
+def _post_table_sql(table_name):
+    return (
+        f"CREATE TABLE {table_name} ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
+        "content TEXT VARCHAR2(5000) NOT NULL,"
+        "author_id INTEGER NOT NULL,"
+        "topic_id INTEGER NOT NULL,"
+        "topic_url_id INTEGER NOT NULL,"
+        "created_at timestamp NOT NULL,"
+        + "".join(f"{score} DOUBLE," for score in SCORE_COLUMNS) +
+        "cluster_id INTEGER,"
+        f"FOREIGN KEY (author_id) REFERENCES {AUTHOR_TABLE_NAME} (id),"
+        f"FOREIGN KEY (topic_id) REFERENCES {TOPIC_TABLE_NAME} (id),"
+        f"FOREIGN KEY (topic_url_id) REFERENCES {TOPIC_URL_TABLE_NAME} (id))"
+    )
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def allow_pending_scores(con):
+    """
+    Make the POST score columns nullable so posts can be stored before they are scored.
+    Databases created before this change have NOT NULL scores and get their POST
+    table rebuilt once; ids are kept.
+    :param con:
+    :return: True when the table was rebuilt
+    """
+    set_up(con)
+    rebuilt = False
+    columns = con.execute(f"PRAGMA table_info({POST_TABLE_NAME})").fetchall()
+    if any(name in SCORE_COLUMNS and notnull for _, name, _, notnull, _, _ in columns):
+        con.commit()
+        con.execute("PRAGMA foreign_keys = OFF")
+        try:
+            con.execute(f"DROP TABLE IF EXISTS {POST_TABLE_NAME}_rebuild")
+            con.execute(_post_table_sql(f"{POST_TABLE_NAME}_rebuild"))
+            names = ", ".join(name for _, name, _, _, _, _ in columns)
+            con.execute(f"INSERT INTO {POST_TABLE_NAME}_rebuild ({names}) SELECT {names} FROM {POST_TABLE_NAME}")
+            con.execute(f"DROP TABLE {POST_TABLE_NAME}")
+            con.execute(f"ALTER TABLE {POST_TABLE_NAME}_rebuild RENAME TO {POST_TABLE_NAME}")
+            if checkTableExists(con, POST_FTS_TABLE_NAME):
+                # the full-text triggers went with the old table
+                _create_fts_triggers(con)
+            con.commit()
+        finally:
+            con.execute("PRAGMA foreign_keys = ON")
+        rebuilt = True
+    con.execute(
+        f"CREATE INDEX IF NOT EXISTS post_unscored ON {POST_TABLE_NAME} (id) WHERE toxicity IS NULL"
+    )
+    con.commit()
+    return rebuilt
 
 
 @retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
@@ -327,3 +367,342 @@ def get_post(con, post_id):
         sql, (post_id),
     )
     return cur.fetchone() 
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def get_known_urls(con):
+    """
+    Every TOPIC_URL link with the newest created_at of the posts stored under it
+    :param con:
+    :return: generator of (link, last created_at or None)
+    """
+    set_up(con)
+    cur = con.cursor()
+    sql = (
+        f"SELECT u.link, MAX(p.created_at) FROM {TOPIC_URL_TABLE_NAME} u"
+        f" LEFT JOIN {POST_TABLE_NAME} p ON p.topic_url_id = u.id GROUP BY u.id"
+    )
+    cur.execute(sql)
+    for link, last_created_at in cur.fetchall():
+        yield link, last_created_at
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def get_post_id_range(con):
+    """
+    Lowest and highest POST id
+    :param con:
+    :return: (min id, max id), (None, None) for an empty table
+    """
+    set_up(con)
+    cur = con.cursor()
+    return cur.execute(f"SELECT MIN(id), MAX(id) FROM {POST_TABLE_NAME}").fetchone()
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def get_unscored_posts(con, start_id, stop_id, limit, include_sentinels=False):
+    """
+    Posts still waiting for toxicity scores with start_id <= id <= stop_id, shortest first
+    :param con:
+    :param start_id:
+    :param stop_id:
+    :param limit: max number of posts
+    :param include_sentinels: also return long posts stored with -1 scores by older runs
+    :return: list of (id, content)
+    """
+    set_up(con)
+    cur = con.cursor()
+    pending = "(toxicity IS NULL OR toxicity = -1)" if include_sentinels else "toxicity IS NULL"
+    sql = (
+        f"SELECT id, content FROM {POST_TABLE_NAME} WHERE {pending}"
+        " AND id BETWEEN (?) AND (?) ORDER BY id LIMIT (?)"
+    )
+    rows = cur.execute(sql, (start_id, stop_id, limit)).fetchall()
+    # sorted here rather than in SQL so the partial index keeps the scan cheap
+    return sorted(rows, key=lambda row: len(row[1]))
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def update_post_scores(con, scored):
+    """
+    Write toxicity scores for many posts in a single transaction
+    :param con:
+    :param scored: iterable of (post id, toxicity dict)
+    :return: number of posts updated
+    """
+    sql = (
+        f"UPDATE {POST_TABLE_NAME} SET "
+        + ", ".join(f"{score} = (?)" for score in SCORE_COLUMNS)
+        + " WHERE id = (?)"
+    )
+    rows = [
+        tuple(toxicity_dict[score] for score in SCORE_COLUMNS) + (post_id,)
+        for post_id, toxicity_dict in scored
+    ]
+    cur = con.cursor()
+    cur.executemany(sql, rows)
+    con.commit()
+    return len(rows)
+
+
+def _create_fts_triggers(con):
+    for table, fts_table, column in (
+        (POST_TABLE_NAME, POST_FTS_TABLE_NAME, "content"),
+        (TOPIC_TABLE_NAME, TOPIC_FTS_TABLE_NAME, "title"),
+    ):
+        con.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {fts_table}_insert AFTER INSERT ON {table} BEGIN"
+            f" INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        )
+        con.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {fts_table}_delete AFTER DELETE ON {table} BEGIN"
+            f" INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END"
+        )
+        # score updates from backfill.py don't touch the text, so only text changes reindex
+        con.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {fts_table}_update AFTER UPDATE OF {column} ON {table} BEGIN"
+            f" INSERT INTO {fts_table}({fts_table}, rowid, {column}) VALUES ('delete', old.id, old.{column});"
+            f" INSERT INTO {fts_table}(rowid, {column}) VALUES (new.id, new.{column}); END"
+        )
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def enable_fts(con, rebuild=False):
+    """
+    Create the FTS5 indexes over POST content and TOPIC titles, kept in sync by triggers
+    on every later insert, update and delete.
+    :param con:
+    :param rebuild: (re)index every existing row, needed once for databases that already hold posts
+    :return: True when the indexes were created or rebuilt
+    """
+    set_up(con)
+    cur = con.cursor()
+    exists = checkTableExists(con, POST_FTS_TABLE_NAME)
+    if not exists:
+        cur.execute(
+            f"CREATE VIRTUAL TABLE {POST_FTS_TABLE_NAME} USING fts5(content,"
+            f" content='{POST_TABLE_NAME}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+        cur.execute(
+            f"CREATE VIRTUAL TABLE {TOPIC_FTS_TABLE_NAME} USING fts5(title,"
+            f" content='{TOPIC_TABLE_NAME}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+    _create_fts_triggers(con)
+    if rebuild or not exists:
+        for fts_table in (POST_FTS_TABLE_NAME, TOPIC_FTS_TABLE_NAME):
+            cur.execute(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+        cur.execute(f"INSERT INTO {POST_FTS_TABLE_NAME}({POST_FTS_TABLE_NAME}) VALUES ('optimize')")
+    con.commit()
+    return rebuild or not exists
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def disable_fts(con):
+    """
+    Stop keeping the full-text indexes in sync, e.g. during a bulk load; enable_fts(con, rebuild=True) catches up
+    :param con:
+    """
+    for fts_table in (POST_FTS_TABLE_NAME, TOPIC_FTS_TABLE_NAME):
+        for event in ("insert", "delete", "update"):
+            con.execute(f"DROP TRIGGER IF EXISTS {fts_table}_{event}")
+    con.commit()
+
+
+class DatabaseLocked(sqlite3.OperationalError):
+    """"database is locked", the only error the query helpers below retry"""
+
+
+@retry(DatabaseLocked, tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def _query(con, sql, params):
+    """
+    Fetch all rows of a read-only query; a malformed FTS5 query fails at once instead of being retried
+    :param con:
+    :param sql:
+    :param params:
+    :return: list of rows
+    """
+    try:
+        return con.cursor().execute(sql, params).fetchall()
+    except sqlite3.OperationalError as e:
+        if "locked" in str(e):
+            raise DatabaseLocked(*e.args) from e
+        raise
+
+
+def search_posts(con, query, limit=100, order="rank"):
+    """
+    Posts matching an FTS5 query, joined back to their scores, authors and topic
+    :param con:
+    :param query: FTS5 query, e.g. 'harvard', '"job market"' or 'tenure NOT denied'
+    :param limit: max number of posts
+    :param order: "rank" for best bm25 match first, "newest" for most recent first
+    :return: generator of dictionaries
+    """
+    order_by = {"rank": "rank", "newest": "p.created_at DESC"}[order]
+    sql = (
+        "SELECT p.id, p.content, p.created_at, a.code, t.title, u.link,"
+        + "".join(f" p.{score}," for score in SCORE_COLUMNS) +
+        f" bm25({POST_FTS_TABLE_NAME}) AS rank"
+        f" FROM {POST_FTS_TABLE_NAME} f JOIN {POST_TABLE_NAME} p ON p.id = f.rowid"
+        f" JOIN {AUTHOR_TABLE_NAME} a ON a.id = p.author_id"
+        f" JOIN {TOPIC_TABLE_NAME} t ON t.id = p.topic_id"
+        f" JOIN {TOPIC_URL_TABLE_NAME} u ON u.id = p.topic_url_id"
+        f" WHERE {POST_FTS_TABLE_NAME} MATCH (?) ORDER BY {order_by} LIMIT (?)"
+    )
+    for row in _query(con, sql, (query, limit)):
+        to_return = {
+            "post_id": row[0],
+            "post_content": row[1],
+            "created_at": row[2],
+            "post_author_code": row[3],
+            "topic_title": row[4],
+            "topic_url_link": row[5],
+        }
+        to_return.update(zip(SCORE_COLUMNS, row[6:6 + len(SCORE_COLUMNS)]))
+        yield to_return
+
+
+def search_topics(con, query, limit=100):
+    """
+    Topics whose title matches an FTS5 query
+    :param con:
+    :param query:
+    :param limit:
+    :return: list of (topic id, title, author code)
+    """
+    sql = (
+        f"SELECT t.id, t.title, a.code FROM {TOPIC_FTS_TABLE_NAME} f"
+        f" JOIN {TOPIC_TABLE_NAME} t ON t.id = f.rowid JOIN {AUTHOR_TABLE_NAME} a ON a.id = t.author_id"
+        f" WHERE {TOPIC_FTS_TABLE_NAME} MATCH (?) ORDER BY rank LIMIT (?)"
+    )
+    return _query(con, sql, (query, limit))
+
+
+def term_toxicity(con, query, threshold=0.5):
+    """
+    How toxic the posts matching an FTS5 query are, unscored and -1 sentinel posts left out
+    :param con:
+    :param query:
+    :param threshold: toxicity at or above which a post counts as toxic
+    :return: dictionary with posts, authors, toxic_share and the mean of every score
+    """
+    sql = (
+        "SELECT COUNT(*), COUNT(DISTINCT p.author_id), AVG(p.toxicity >= (?)),"
+        + ",".join(f" AVG(p.{score})" for score in SCORE_COLUMNS) +
+        f" FROM {POST_FTS_TABLE_NAME} f JOIN {POST_TABLE_NAME} p ON p.id = f.rowid"
+        f" WHERE {POST_FTS_TABLE_NAME} MATCH (?) AND p.toxicity >= 0"
+    )
+    row = _query(con, sql, (threshold, query))[0]
+    to_return = {"query": query, "posts": row[0], "authors": row[1], "toxic_share": row[2]}
+    to_return.update((f"mean_{score}", value) for score, value in zip(SCORE_COLUMNS, row[3:]))
+    return to_return
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def enable_near_duplicates(con):
+    """
+    Create the MinHash signature and LSH bucket tables used by near_dup.py and the
+    POST.cluster_id column, for databases created before it existed.
+    :param con:
+    """
+    set_up(con)
+    cur = con.cursor()
+    columns = [row[1] for row in cur.execute(f"PRAGMA table_info({POST_TABLE_NAME})").fetchall()]
+    if "cluster_id" not in columns:
+        cur.execute(f"ALTER TABLE {POST_TABLE_NAME} ADD COLUMN cluster_id INTEGER")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS post_cluster ON {POST_TABLE_NAME} (cluster_id)")
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {MINHASH_TABLE_NAME} ("
+        "post_id INTEGER PRIMARY KEY NOT NULL,"
+        "signature BLOB NOT NULL,"
+        f"FOREIGN KEY (post_id) REFERENCES {POST_TABLE_NAME} (id))"
+    )
+    cur.execute(
+        f"CREATE TABLE IF NOT EXISTS {LSH_TABLE_NAME} ("
+        "band INTEGER NOT NULL,"
+        "bucket INTEGER NOT NULL,"
+        "post_id INTEGER NOT NULL,"
+        f"FOREIGN KEY (post_id) REFERENCES {POST_TABLE_NAME} (id))"
+    )
+    cur.execute(f"CREATE INDEX IF NOT EXISTS post_lsh_bucket ON {LSH_TABLE_NAME} (band, bucket)")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS post_lsh_post ON {LSH_TABLE_NAME} (post_id)")
+    con.commit()
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def get_minhash_candidates(con, buckets, limit):
+    """
+    Signatures of the newest posts sharing at least one LSH bucket
+    :param con:
+    :param buckets: list of (band, bucket)
+    :param limit: max number of candidates
+    :return: list of (post id, signature blob)
+    """
+    # one equality lookup per band, a row value IN (VALUES ...) makes SQLite scan the whole table
+    arms = " UNION ALL ".join(f"SELECT post_id FROM {LSH_TABLE_NAME} WHERE band = (?) AND bucket = (?)" for _ in buckets)
+    sql = (
+        f"SELECT post_id, signature FROM {MINHASH_TABLE_NAME} WHERE post_id IN ({arms})"
+        " ORDER BY post_id DESC LIMIT (?)"
+    )
+    params = [value for bucket in buckets for value in bucket] + [limit]
+    cur = con.cursor()
+    return cur.execute(sql, params).fetchall()
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def get_post_scores(con, post_id):
+    """
+    :param con:
+    :param post_id:
+    :return: toxicity dictionary, None when the post is not scored yet
+    """
+    sql = f"SELECT {', '.join(SCORE_COLUMNS)} FROM {POST_TABLE_NAME} WHERE id = (?)"
+    cur = con.cursor()
+    row = cur.execute(sql, (post_id,)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return dict(zip(SCORE_COLUMNS, row))
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def get_post_cluster(con, post_id):
+    cur = con.cursor()
+    row = cur.execute(f"SELECT cluster_id FROM {POST_TABLE_NAME} WHERE id = (?)", (post_id,)).fetchone()
+    return row[0] if row and row[0] is not None else post_id
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def record_minhash(con, post_id, signature, buckets, cluster_id):
+    """
+    Store a post's MinHash signature, its LSH buckets and its near-duplicate cluster
+    :param con:
+    :param post_id:
+    :param signature: signature blob, None for a post that must never be a candidate
+    :param buckets: list of (band, bucket)
+    :param cluster_id:
+    """
+    cur = con.cursor()
+    cur.execute(f"UPDATE {POST_TABLE_NAME} SET cluster_id = (?) WHERE id = (?)", (cluster_id, post_id))
+    cur.execute(f"DELETE FROM {LSH_TABLE_NAME} WHERE post_id = (?)", (post_id,))
+    if signature is None:
+        cur.execute(f"DELETE FROM {MINHASH_TABLE_NAME} WHERE post_id = (?)", (post_id,))
+        con.commit()
+        return
+    cur.execute(
+        f"INSERT OR REPLACE INTO {MINHASH_TABLE_NAME}(post_id, signature) VALUES (?, ?)", (post_id, signature)
+    )
+    cur.executemany(
+        f"INSERT INTO {LSH_TABLE_NAME}(band, bucket, post_id) VALUES (?, ?, ?)",
+        [(band, bucket, post_id) for band, bucket in buckets],
+    )
+    con.commit()
+
+
+@retry(tries=21, delay=0.1, backoff=1.2, max_delay=4, logger=None)
+def drop_secondary_indexes(con):
+    """
+    Drop the optional POST and LSH indexes before a bulk load; allow_pending_scores and
+    enable_near_duplicates create them again
+    :param con:
+    """
+    for index in ("post_unscored", "post_cluster", "post_lsh_bucket", "post_lsh_post"):
+        con.execute(f"DROP INDEX IF EXISTS {index}")
+    con.commit()
@@ -0,0 +1,169 @@
+"""Split the machine's cores between scraper threads, scoring processes and torch threads
+
+Left alone, every scoring process runs PyTorch with about cpu_count() intra-op threads,
+so N consumers on a 32 core box means N*32 compute threads fighting over 32 cores.
+A plan gives each scoring worker its own slice of cores and sizes the I/O side apart.
+
+example:
+    plan = topology.plan()                     # static split of os.cpu_count()
+    plan = topology.auto_tune(scorer="quantized")  # pick the fastest split on this box
+    topology.apply(topology.worker_settings(plan, 0))  # inside scoring worker 0
+"""
+import logging
+import os
+import random
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import fire
+
+logger = logging.getLogger(__name__)
+
+VOCAB = (
+    "econ", "job", "market", "fly", "out", "tenure", "referee", "paper", "seminar", "dean",
+    "placement", "rumor", "offer", "macro", "micro", "metrics", "idiot", "clown", "great", "terrible",
+)
+
+
+def _available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan(cpus=None, torch_threads=None, scoring_workers=None, io_threads=None, reserve=None, pin=False):
+    """Decide how many scoring workers to run and how many cores each gets
+
+    Args:
+        cpus (int): cores to plan for, defaults to the cores this process may use
+        torch_threads (int): intra-op threads per scoring worker, default 4 (fewer on small boxes)
+        scoring_workers (int): scoring processes, default as many as the scoring cores allow
+        io_threads (int): scraper threads, default 2 per core as they mostly wait on the network
+        reserve (int): cores kept for the scrapers and the main process, default 1 when cpus > 2
+        pin (bool): pin every scoring worker to its own cores (Linux only)
+
+    Returns:
+        dict with scrapers, consumers, torch_threads, interop_threads and a core list per consumer
+    """
+    cores = _available_cores()
+    cpus = min(cpus or len(cores), len(cores))
+    cores = cores[:cpus]
+    reserve = (1 if cpus > 2 else 0) if reserve is None else reserve
+    scoring_cores = max(1, cpus - reserve)
+
+    if torch_threads is None:
+        torch_threads = min(4, scoring_cores)
+        if scoring_workers:
+            torch_threads = max(1, scoring_cores // scoring_workers)
+    torch_threads = min(torch_threads, scoring_cores)
+    scoring_workers = scoring_workers or max(1, scoring_cores // torch_threads)
+
+    # the reserved cores come first, scoring workers get consecutive slices of the rest
+    scoring_pool = cores[reserve:] or cores
+    consumer_cores = [
+        [scoring_pool[(i * torch_threads + j) % len(scoring_pool)] for j in range(torch_threads)]
+        for i in range(scoring_workers)
+    ]
+    return {
+        "cpus": cpus,
+        "scrapers": io_threads or max(1, cpus * 2),
+        "consumers": scoring_workers,
+        "torch_threads": torch_threads,
+        "interop_threads": 1,
+        "pin": pin,
+        "consumer_cores": consumer_cores,
+    }
+
+
+def worker_settings(plan, index):
+    """Settings of scoring worker index, small enough to pass to a worker process"""
+    return {
+        "torch_threads": plan["torch_threads"],
+        "interop_threads": plan["interop_threads"],
+        "cores": plan["consumer_cores"][index % len(plan["consumer_cores"])] if plan["pin"] else None,
+    }
+
+
+def apply(settings):
+    """Apply worker settings to the current process, call before the model is loaded"""
+    if not settings:
+        return
+    threads = str(settings["torch_threads"])
+    os.environ["OMP_NUM_THREADS"] = threads
+    os.environ["MKL_NUM_THREADS"] = threads
+
+    if settings.get("cores") and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, settings["cores"])
+
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(settings["torch_threads"])
+    try:
+        torch.set_num_interop_threads(settings["interop_threads"])
+    except RuntimeError:
+        # only allowed once per process, before any inter-op work has started
+        logger.debug("torch inter-op threads already set")
+
+
+def _score_worker(settings, scorer, posts, batch_size, scorer_options=None):
+    import toxicity_measure
+
+    apply(settings)
+    toxicity_measure.set_backend(scorer, **(scorer_options or {}))
+    toxicity_measure.measure_posts(posts[:batch_size], batch_size)  # load and warm up
+    start = time.perf_counter()
+    toxicity_measure.measure_posts(posts, batch_size)
+    return time.perf_counter() - start
+
+
+def measure(plan, scorer="detoxify", posts_per_worker=256, batch_size=32, seed=0, scorer_options=None):
+    """Posts/s of a plan's scoring workers all running at once on synthetic posts"""
+    rng = random.Random(seed)
+    posts = [" ".join(rng.choice(VOCAB) for _ in range(rng.randint(5, 200))) for _ in range(posts_per_worker)]
+    with ProcessPoolExecutor(plan["consumers"]) as executor:
+        futures = [
+            executor.submit(_score_worker, worker_settings(plan, i), scorer, posts, batch_size, scorer_options)
+            for i in range(plan["consumers"])
+        ]
+        walls = [fut.result() for fut in futures]
+    return plan["consumers"] * posts_per_worker / max(walls)
+
+
+def auto_tune(cpus=None, scorer="detoxify", candidates=(1, 2, 4, 8), pin=False, posts_per_worker=256, batch_size=32,
+              scorer_options=None):
+    """Try a plan per torch thread count in candidates and return the one with the most posts/s
+
+    Args:
+        cpus (int): cores to plan for
+        scorer (str): scorer backend to benchmark, see scorers.BACKENDS
+        candidates (tuple of int): intra-op thread counts per worker to try
+        pin (bool): pin workers to cores
+        posts_per_worker (int): synthetic posts every worker scores
+        batch_size (int): windows per forward pass
+        scorer_options (dict): backend options, e.g. {"checkpoint": path}, as passed to set_backend
+
+    Returns:
+        the fastest plan, with its measured posts_per_s
+    """
+    best = None
+    tried = set()
+    for torch_threads in candidates:
+        candidate = plan(cpus, torch_threads=torch_threads, pin=pin)
+        key = (candidate["consumers"], candidate["torch_threads"])
+        if key in tried:
+            continue
+        tried.add(key)
+        candidate["posts_per_s"] = round(measure(candidate, scorer, posts_per_worker, batch_size, scorer_options=scorer_options), 2)
+        logger.info(
+            f"{candidate['consumers']} workers x {candidate['torch_threads']} threads: {candidate['posts_per_s']} posts/s"
+        )
+        if best is None or candidate["posts_per_s"] > best["posts_per_s"]:
+            best = candidate
+    return best
+
+
+if __name__ == "__main__":
+    fire.Fire({"plan": plan, "auto_tune": auto_tune})
@@ -1,13 +1,108 @@
-from detoxify import Detoxify
-detox = Detoxify('multilingual')
+import threading
+
+import metrics
+import scorers
+
+BACKEND = "detoxify" # scorer backend, see scorers.BACKENDS
+BACKEND_OPTIONS = {} # keyword arguments for the backend, e.g. {"checkpoint": path}
+WINDOW_TOKENS = 510 # model limit of 512 minus the <s> and </s> tokens
+WINDOW_OVERLAP = 64 # tokens shared by consecutive windows of a long post
+WINDOW_REDUCE = "max" # how window scores combine into a post score, "max" or "mean"
+
+detox = None
+_detox_lock = threading.Lock()
+
+
+def get_detox():
+    # loaded on first use so importing this module (e.g. from the benchmark) stays cheap
+    global detox
+    with _detox_lock:
+        if detox is None:
+            detox = scorers.load_backend(BACKEND, **BACKEND_OPTIONS)
+    return detox
+
+
+def set_backend(name, **options):
+    """Switch every later measurement of this process to another scorer backend, loaded on first use"""
+    global detox, BACKEND, BACKEND_OPTIONS
+    with _detox_lock:
+        if (name, options) != (BACKEND, BACKEND_OPTIONS):
+            detox = None
+        BACKEND, BACKEND_OPTIONS = name, options
+
+
+def _tokenize(contents):
+    tokenizer = getattr(get_detox(), "tokenizer", None)
+    if tokenizer is None:
+        # stand-in models without a tokenizer, whitespace words play the part of tokens
+        return [content.split() for content in contents]
+    return tokenizer(list(contents), add_special_tokens=False)["input_ids"]
+
+
+def _detokenize(tokens):
+    tokenizer = getattr(get_detox(), "tokenizer", None)
+    if tokenizer is None:
+        return " ".join(tokens)
+    return tokenizer.decode(tokens)
+
+
+def split_windows(tokens, window=None, overlap=None):
+    """Overlapping slices of at most window tokens covering every token, WINDOW_TOKENS / WINDOW_OVERLAP by default"""
+    window = WINDOW_TOKENS if window is None else window
+    overlap = WINDOW_OVERLAP if overlap is None else overlap
+    if len(tokens) <= window:
+        return [tokens]
+    step = window - overlap
+    return [tokens[start:start + window] for start in range(0, len(tokens) - overlap, step)]
+
 
 # each model takes in either a string or a list of strings
 def count_then_measure_post(content: str):
-    if len(content.split()) >= 512:
-        return {"toxicity": -1, "severe_toxicity": -1, "obscene": -1, "threat": -1, "insult": -1, "identity_attack": -1, "sexual_explicit": -1}
-    else:
-        to_return = {}
-        for k,v in detox.predict(content).items():
-            to_return[k] = v.item()
-
-        return to_return
+    return measure_posts([content])[0]
+
+
+def measure_posts(contents, batch_size=64, reduce=None):
+    """Score many posts with one forward pass per batch_size windows
+
+    Every post is measured with the model's own tokenizer. Posts longer than the model
+    limit are split into overlapping windows; windows of all posts are batched together
+    (similar lengths side by side) and their scores combined back per post.
+
+    Args:
+        contents (list of str): post texts
+        batch_size (int): windows per forward pass
+        reduce (str): "max" or "mean" of the window scores of a post, WINDOW_REDUCE by default
+
+    Returns:
+        list of score dictionaries, in the order of contents
+    """
+    reduce = WINDOW_REDUCE if reduce is None else reduce
+    if reduce not in ("max", "mean"):
+        raise ValueError(f"reduce must be 'max' or 'mean', not {reduce!r}")
+    if not contents:
+        # the fast tokenizers fail on an empty batch
+        return []
+
+    windows = []  # (post index, token count, text)
+    for i, (content, tokens) in enumerate(zip(contents, _tokenize(contents))):
+        if len(tokens) <= WINDOW_TOKENS:
+            windows.append((i, len(tokens), content))
+        else:
+            windows.extend((i, len(w), _detokenize(w)) for w in split_windows(tokens))
+    windows.sort(key=lambda w: w[1])
+
+    window_scores = [[] for _ in contents]
+    for start in range(0, len(windows), batch_size):
+        batch = windows[start:start + batch_size]
+        with metrics.timer("score_batch"):
+            scores = get_detox().predict([text for _, _, text in batch])
+        for j, (i, _, _) in enumerate(batch):
+            window_scores[i].append({k: float(v[j]) for k, v in scores.items()})
+
+    to_return = []
+    for post_scores in window_scores:
+        if reduce == "max":
+            to_return.append({k: max(s[k] for s in post_scores) for k in post_scores[0]})
+        else:
+            to_return.append({k: sum(s[k] for s in post_scores) / len(post_scores) for k in post_scores[0]})
+    return to_return
@@ -0,0 +1,85 @@
+import datetime
+import threading
+
+import sql
+
+_UNKNOWN = object()
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+class KnownUrls:
+    """In-memory membership index of topic links already in TOPIC_URL
+
+    Loaded once from the database, then kept current by the scrapers as they hand
+    topics to the DB consumers, so skip decisions never touch SQLite. Each link maps
+    to the time it was last ingested (for links loaded from the database this is the
+    newest created_at of its posts, the closest thing the schema records).
+    """
+
+    def __init__(self, last_ingested=None):
+        self._last_ingested = dict(last_ingested or {})
+        self._previous = {}  # link -> what claim() replaced, until done() or release()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, con):
+        return cls(
+            (link, _as_datetime(last_created_at))
+            for link, last_created_at in sql.get_known_urls(con)
+        )
+
+    def __contains__(self, link):
+        return link in self._last_ingested
+
+    def __len__(self):
+        return len(self._last_ingested)
+
+    def done(self, link):
+        """The claimed topic was queued, its claim can no longer be undone"""
+        with self._lock:
+            self._previous.pop(link, None)
+
+    def release(self, link):
+        """Undo claim() after a failed scrape, a link known before keeps its old timestamp"""
+        with self._lock:
+            if link not in self._previous:
+                return
+            previous = self._previous.pop(link)
+            if previous is _UNKNOWN:
+                self._last_ingested.pop(link, None)
+            else:
+                self._last_ingested[link] = previous
+
+    def claim(self, link, last_update=None, is_fresh=None):
+        """Decide whether a topic should be scraped, and if so mark it as ingested
+
+        Unknown links are always claimed. Known links are claimed again only when
+        ``is_fresh(last_update)`` holds and the topic changed after we last took it,
+        so two index pages listing the same topic never queue it twice.
+
+        Args:
+            link (str): topic link from get_discussion_urls
+            last_update (datetime): last activity reported on the index page
+            is_fresh (callable): freshness predicate for last_update
+
+        Returns:
+            bool, True when the caller should scrape the topic
+        """
+        with self._lock:
+            if link in self._last_ingested:
+                if last_update is None or is_fresh is None or not is_fresh(last_update):
+                    return False
+                last_ingested = self._last_ingested[link]
+                if last_ingested is not None and last_ingested >= last_update:
+                    return False
+            self._previous[link] = self._last_ingested.get(link, _UNKNOWN)
+            self._last_ingested[link] = datetime.datetime.now()
+            return True
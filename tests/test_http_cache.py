@@ -0,0 +1,74 @@
+"""Conditional requests and parse caching against the benchmark stand-in server"""
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import benchmark  # noqa: E402
+import emjr  # noqa: E402
+import http_cache  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    server, _ = benchmark.serve(benchmark.make_corpus(index_pages=1, topics_per_index=3, pages_per_topic=2))
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_cache, "_last_updates", {})
+    http_cache.configure(str(tmp_path / "http_cache.db"))
+    yield
+    http_cache.configure(None)
+
+
+def test_index_revalidates_with_etag(server, cache, monkeypatch):
+    sent = []
+    parse = http_cache.put_parsed
+    monkeypatch.setattr(http_cache, "put_parsed", lambda *args: sent.append(args[0]) or parse(*args))
+
+    first = emjr.get_discussion_urls(server.base_url)
+    assert server.not_modified == 0
+    second = emjr.get_discussion_urls(server.base_url)
+
+    assert server.not_modified == 1
+    assert second == first
+    # the 304 body came from the cache and so did its parse
+    assert sent == ["get_discussion_urls"]
+
+
+def test_topic_page_revalidates_with_etag(server, cache):
+    url = f"{server.base_url}topic/topic-1-0"
+    first = emjr.collect_posts(url)
+    second = emjr.collect_posts(url)
+    assert server.not_modified == 1
+    assert second == first and first
+
+
+def test_topic_unchanged_since_fetch_needs_no_request(server, cache):
+    link = emjr.get_discussion_urls(server.base_url)[0]["link"]
+    first = emjr.collect_posts(link)
+    requests = server.requests
+
+    # the index reports the topic's last activity before we fetched it
+    assert emjr.collect_posts(link) == first
+    assert server.requests == requests
+
+    # new activity after the fetch makes the next call ask the server again
+    http_cache.note_last_updates([{"link": link, "last_update": datetime.datetime.now() + datetime.timedelta(hours=1)}])
+    assert emjr.collect_posts(link) == first
+    assert server.requests == requests + 1
+    assert server.not_modified == 1
+
+
+def test_disabled_cache_always_downloads(server):
+    http_cache.configure(None)
+    emjr.get_discussion_urls(server.base_url)
+    emjr.get_discussion_urls(server.base_url)
+    assert server.requests == 2
+    assert server.not_modified == 0
@@ -0,0 +1,61 @@
+"""Near-duplicate planning of a topic's posts"""
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import near_dup  # noqa: E402
+import sql  # noqa: E402
+
+WORDS = [f"word{i}" for i in range(500)]
+
+
+@pytest.fixture
+def con():
+    con = sqlite3.connect(":memory:")
+    sql.set_up(con)
+    sql.allow_pending_scores(con)
+    sql.enable_near_duplicates(con)
+    yield con
+    con.close()
+
+
+def _post(rng, words=40):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def test_quoted_post_reuses_earlier_post(con):
+    rng = random.Random(0)
+    original = _post(rng)
+    planned = near_dup.plan_topic(con, [original, _post(rng), "> " + original.upper() + "!"])
+    assert [neighbor for _, neighbor in planned] == [None, None, ("batch", 0)]
+
+
+def test_posts_without_words_never_match(con):
+    planned = near_dup.plan_topic(con, ["😂😂", "!!!", "", "😂😂"])
+    assert [neighbor for _, neighbor in planned] == [None] * 4
+
+
+def test_megathread_compares_only_bucket_candidates(con, monkeypatch):
+    rng = random.Random(1)
+    repeated = [_post(rng) for _ in range(50)]
+    posts = [rng.choice(repeated) if rng.random() < 0.5 else _post(rng) for _ in range(4000)]
+    posts += ["the same short reply"] * 1000
+
+    calls = []
+    similarity = near_dup.similarity
+    monkeypatch.setattr(near_dup, "similarity", lambda a, b: calls.append(1) or similarity(a, b))
+    planned = near_dup.plan_topic(con, posts)
+
+    # comparing against every earlier post would take more than 12 million calls
+    assert len(calls) < 10 * len(posts)
+    first_seen = {}
+    for i, (post, (_, neighbor)) in enumerate(zip(posts, planned)):
+        if post in first_seen:
+            assert neighbor is not None and neighbor[0] == "batch"
+            assert posts[neighbor[1]] == post
+        first_seen.setdefault(post, i)
@@ -0,0 +1,71 @@
+"""Sharded crawls as local processes against the benchmark stand-in server"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import benchmark  # noqa: E402
+import shards  # noqa: E402
+import sql  # noqa: E402
+
+INDEX_PAGES = 4
+TOPICS_PER_INDEX = 3
+PAGES_PER_TOPIC = 2
+POSTS_PER_PAGE = 5
+
+
+@pytest.fixture
+def site():
+    corpus = benchmark.make_corpus(INDEX_PAGES, TOPICS_PER_INDEX, PAGES_PER_TOPIC, POSTS_PER_PAGE)
+    server, base_url = benchmark.serve(corpus)
+    yield base_url
+    server.shutdown()
+
+
+def test_page_range_covers_every_page_once():
+    for pages in range(1, 12):
+        for count in range(1, pages + 1):
+            ranges = [shards.page_range(1, pages, shard, count) for shard in range(count)]
+            covered = [page for first, last in ranges for page in range(first, last + 1)]
+            assert covered == list(range(1, pages + 1))
+            assert all(first <= last for first, last in ranges)
+
+
+def test_page_range_rejects_more_shards_than_pages():
+    with pytest.raises(ValueError):
+        shards.page_range(1, 3, 3, 4)
+
+
+@pytest.mark.parametrize("count, by", [(2, "pages"), (3, "topics")])
+def test_launch_and_merge(site, tmp_path, monkeypatch, count, by):
+    # main.py writes its metrics and page cache to the working directory
+    monkeypatch.chdir(tmp_path)
+    db_name = str(tmp_path / "all_posts.db")
+
+    added = shards.launch(count, db_name, by=by, base_url=site, start=1, stop=INDEX_PAGES, scorer="stand-in")
+
+    expected = INDEX_PAGES * TOPICS_PER_INDEX * PAGES_PER_TOPIC * POSTS_PER_PAGE
+    assert added == expected
+    for shard in range(count):
+        assert os.path.exists(shards.shard_db_name(db_name, shard, count))
+    with sqlite3.connect(db_name) as con:
+        posts, scored = con.execute(f"SELECT COUNT(*), COUNT(toxicity) FROM {sql.POST_TABLE_NAME}").fetchone()
+        topic_urls = con.execute(f"SELECT COUNT(*) FROM {sql.TOPIC_URL_TABLE_NAME}").fetchone()[0]
+    assert posts == scored == expected
+    assert topic_urls == INDEX_PAGES * TOPICS_PER_INDEX * PAGES_PER_TOPIC
+
+    # merging the same shards again adds nothing
+    assert shards.merge(db_name, *(shards.shard_db_name(db_name, shard, count) for shard in range(count))) == 0
+
+
+def test_launch_rejects_more_shards_than_pages(site, tmp_path):
+    with pytest.raises(ValueError):
+        shards.launch(INDEX_PAGES + 1, str(tmp_path / "all_posts.db"), base_url=site, start=1, stop=INDEX_PAGES)
+
+
+def test_launch_rejects_a_single_shard(site, tmp_path):
+    with pytest.raises(ValueError):
+        shards.launch(1, str(tmp_path / "all_posts.db"), base_url=site, start=1, stop=INDEX_PAGES)